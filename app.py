@@ -1,12 +1,335 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, request, jsonify, g, send_file, stream_with_context, has_app_context, has_request_context
+import click
+import numpy as np
+from werkzeug.security import safe_join
+import atexit
+import bisect
+import codecs
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import mimetypes
+import os
+import queue
+import re
+import shutil
 import sqlite3
-from datetime import datetime
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
 app = Flask(__name__)
+app.config.from_mapping(
+    DATABASE='locations.db',
+    SQLITE_SYNCHRONOUS='NORMAL',       # safe with WAL; FULL fsyncs every commit
+    SQLITE_CACHE_SIZE=-20000,          # negative values are KiB, i.e. ~20 MB page cache
+    SQLITE_MMAP_SIZE=256 * 1024 * 1024,
+    SQLITE_BUSY_TIMEOUT=5000,          # ms to wait for the write lock
+    SQLITE_CACHED_STATEMENTS=256,      # prepared statements kept per connection
+    SQLITE_POOL_SIZE=16,               # idle connections kept per worker
+    BULK_CHUNK_SIZE=5000,              # rows per executemany in /add_locations
+    BULK_MAX_ERRORS=1000,              # per-row errors reported back by /add_locations
+    CLUSTER_CELL_PX=80,                # cluster grid cell size in screen pixels
+    CLUSTER_MIN_ZOOM=10,
+    CLUSTER_MAX_ZOOM=17,
+    BULK_NOTIFY_ROWS=10000,            # larger bulk writes invalidate derived caches wholesale
+    IMPORT_CHUNK_ROWS=10000,           # rows per transaction in /import and `flask import-locations`
+    TILE_CACHE_DIR='tile_cache',
+    TILE_MIN_ZOOM=10,
+    TILE_MAX_ZOOM=18,
+    TILE_MAX_AGE=30,                   # seconds clients and proxies may reuse a tile
+    STREAM_CHUNK_ROWS=2000,            # rows fetched and encoded per chunk on reads
+    PAGE_MAX_ROWS=1000,                # largest limit accepted by /locations_page
+    PAGE_RTREE_MAX_AREA=0.01,          # share of the district a /locations_page bbox may cover and use the R*Tree
+    RESPONSE_CACHE_BYTES=64 * 1024 * 1024,  # 0 disables the read cache
+    RESPONSE_GZIP_MIN_BYTES=1024,      # smaller bodies are not precompressed
+    SCHEDULE_TIMEZONE='Asia/Kolkata',  # zone of the wall-clock times in schedules
+    HAZARD_GRID_M=250,                 # grid cell size of the /check_positions hazard index
+    HAZARD_MAX_RADIUS_M=5000,
+    HEATMAP_CELL_PX=16,                # heatmap cell size in screen pixels at each zoom
+    HEATMAP_MIN_ZOOM=10,
+    HEATMAP_MAX_ZOOM=14,               # base grid resolution; coarser zooms are summed from it
+    ASYNC_WRITES=False,                # queue /add_location rows for a background group-commit writer
+    WRITE_QUEUE_SIZE=10000,
+    WRITE_BATCH_SIZE=500,              # rows per group commit at most
+    WRITE_BATCH_WINDOW_MS=50,          # how long a batch waits for more rows
+    WRITE_ENQUEUE_TIMEOUT=0.5,         # seconds a request waits on a full queue before a 503
+    WRITE_RETRY_SECONDS=60,            # how long a batch is retried while the database is busy or locked
+    EVENT_BUFFER_SIZE=10000,           # recent /events kept for Last-Event-ID replay
+    EVENT_HEARTBEAT=15,                # seconds between keep-alive comments on idle streams
+    SLOW_REQUEST_MS=0,                 # log requests slower than this with their SQL time; 0 disables
+    SLOW_QUERY_MS=0,                   # log statements slower than this with their query plan; 0 disables
+    RETENTION_DAYS=0,                  # raw points older than this are rolled up and deleted; 0 keeps everything
+    RETENTION_INTERVAL=3600,           # seconds between retention runs inside the server process
+    RETENTION_BATCH_ROWS=1000,         # rows rolled up and deleted per write transaction
+    RETENTION_PAUSE_MS=50,             # pause between batches so live writes get the lock
+    ROLLUP_CELL_DEG=0.01,              # rollup grid cell in degrees (~1.1 km); keep fixed once rollups exist
+    SPEED_STATS_CELL_DEG=0.01,         # /speed_stats grid cell in degrees; a change rebuilds the table on init
+    LOCATION_STORE=True,               # serve reads from an in-process columnar copy of locations
+    DEDUP_RADIUS_M=0,                  # merge new reports this close to an incident of the same type; 0 disables
+    DEDUP_WINDOW=3600,                 # ...when their timestamps are at most this many seconds apart
+    DEDUP_TYPES=('accidents', 'crowded'),  # types whose reports are merged
+    ASSET_DIR='static/dist',           # output of `npm run build`; the page falls back to CDNs without it
+    ASSET_MAX_AGE=365 * 24 * 3600,     # fingerprinted assets never change under the same name
+)
+app.config.from_prefixed_env()
+
+LOCATION_TYPES = ('accidents', 'crowded', 'hospitals', 'schools')
+LOCATION_FIELDS = ('type', 'lat', 'lon', 'speed', 'timestamp', 'days', 'time_from', 'time_to')
+# Columns of a location as the API returns it; report_count is kept by the server, not posted
+LOCATION_COLUMNS = 'id, ' + ', '.join(LOCATION_FIELDS) + ', report_count'
+LOCATION_SELECT = 'SELECT ' + ', '.join('l.' + c for c in LOCATION_COLUMNS.split(', '))
+COLUMNAR_MIMETYPE = 'application/vnd.locations.columnar+json'
+EARTH_RADIUS_M = 6371008.8
+DAYS_OF_WEEK = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+ALL_DAYS = 0x7f
+# Rows from location_row(): the API fields followed by the compiled schedule columns and epoch time
+INSERT_LOCATION_SQL = ('INSERT INTO locations (type, lat, lon, speed, timestamp, days, time_from, time_to, '
+                       'day_mask, minute_from, minute_to, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+UPDATE_LOCATION_SQL = ('UPDATE locations SET type=?, lat=?, lon=?, speed=?, timestamp=?, days=?, time_from=?, time_to=?, '
+                       'day_mask=?, minute_from=?, minute_to=?, ts=? WHERE id=?')
+ROW_COLUMNS = LOCATION_FIELDS + ('day_mask', 'minute_from', 'minute_to', 'ts')
+SCHEDULE_FIELDS = ('days', 'time_from', 'time_to')
+# Fields a filtered bulk update may set; moving many points to one position is never intended
+BULK_PATCH_FIELDS = ('type', 'speed', 'timestamp', 'days', 'time_from', 'time_to')
+
+# Map bounds of Tanjore district as (south, west), (north, east); mirrors maxBounds in initMap
+TANJORE_BOUNDS = ((10.05, 78.8), (11.2, 79.7))
+
+# Histograms and counters exposed at /metrics, kept per worker process
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Time until the handler returned its response', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('Response body size, counted as streams are sent', SIZE_BUCKETS),
+    'sqlite_statement_duration_seconds': ('Time spent executing SQL statements and commits', LATENCY_BUCKETS),
+}
+COUNTERS = {
+    'http_responses_total': 'Responses by route and status',
+    'sqlite_fetch_seconds_total': 'Time spent fetching rows from cursors',
+    'sqlite_acquire_seconds_total': 'Time spent borrowing or opening a connection',
+    'sqlite_connections_opened_total': 'Connections opened',
+}
+_metrics_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> per-bucket counts, then sum and count
+_counters = {}
+
+# Add one observation to a histogram
+def observe(name, labels, value):
+    buckets = HISTOGRAMS[name][1]
+    with _metrics_lock:
+        values = _histograms.get((name, labels))
+        if values is None:
+            values = _histograms[(name, labels)] = [0] * (len(buckets) + 3)
+        values[bisect.bisect_left(buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+# Increment a counter
+def count(name, labels, value=1):
+    with _metrics_lock:
+        _counters[(name, labels)] = _counters.get((name, labels), 0) + value
+
+# Route label for metrics recorded in the current context
+def metric_route():
+    if not has_request_context():
+        return 'background'
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+# Record one timed statement; the plans of slow ones are kept for the slow-request log
+def record_statement(conn, sql, params, elapsed):
+    op = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    observe('sqlite_statement_duration_seconds', (('route', metric_route()), ('op', op)), elapsed)
+    in_request = has_app_context() and 'request_start' in g
+    if in_request:
+        g.sql_seconds += elapsed
+        g.sql_statements += 1
+    slow_ms = app.config['SLOW_QUERY_MS']
+    if not slow_ms or elapsed * 1000 < slow_ms:
+        return
+    plan = None
+    if params is not None and op in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+        try:
+            plan = [r[3] for r in conn.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        except sqlite3.Error as e:
+            plan = ['unavailable: %s' % e]
+    entry = (elapsed, ' '.join(sql.split()), plan)
+    if in_request:
+        g.slow_statements.append(entry)
+    else:
+        app.logger.warning('Slow statement outside a request:%s', format_statements([entry]))
+
+# Slow statements as indented log lines with their query plans
+def format_statements(entries):
+    lines = []
+    for elapsed, sql, plan in entries:
+        lines.append('\n  %.1f ms  %s' % (elapsed * 1000, sql))
+        lines.extend('\n    plan: %s' % step for step in plan or ())
+    return ''.join(lines)
+
+# Cursor that reports execute and fetch time. Rows read by iterating the cursor directly
+# are not timed, to keep per-row overhead out of large scans.
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_statement(self.connection, sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, rows):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, rows)
+        finally:
+            record_statement(self.connection, sql, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            count('sqlite_fetch_seconds_total', (('route', metric_route()),), time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            count('sqlite_fetch_seconds_total', (('route', metric_route()),), time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            count('sqlite_fetch_seconds_total', (('route', metric_route()),), time.perf_counter() - start)
+
+# Connection whose statements and commits all go through TimedCursor
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.cursor().executemany(sql, rows)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            record_statement(self, 'COMMIT', None, time.perf_counter() - start)
+
+# Idle connections shared by the request threads of this worker
+_pool = queue.LifoQueue()
+_connections = set()
+
+# Open a connection in WAL mode with the configured pragmas
+def connect_db():
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, factory=TimedConnection,
+                           timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000,
+                           cached_statements=app.config['SQLITE_CACHED_STATEMENTS'])
+    count('sqlite_connections_opened_total', ())
+    # WAL is persistent; switching modes needs an exclusive lock, so only do it once
+    if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+        conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=%s' % app.config['SQLITE_SYNCHRONOUS'])
+    conn.execute('PRAGMA cache_size=%d' % int(app.config['SQLITE_CACHE_SIZE']))
+    conn.execute('PRAGMA mmap_size=%d' % int(app.config['SQLITE_MMAP_SIZE']))
+    conn.execute('PRAGMA busy_timeout=%d' % int(app.config['SQLITE_BUSY_TIMEOUT']))
+    _connections.add(conn)
+    return conn
+
+# Connection for the current request, borrowed from the pool on first use
+def get_db():
+    if 'db' not in g:
+        start = time.perf_counter()
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+        count('sqlite_acquire_seconds_total', (('route', metric_route()),), time.perf_counter() - start)
+    return g.db
+
+# Hand the request's connection back to the pool, discarding any unfinished transaction
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    if _pool.qsize() < app.config['SQLITE_POOL_SIZE']:
+        _pool.put(conn)
+    else:
+        _connections.discard(conn)
+        conn.close()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_seconds = 0.0
+    g.sql_statements = 0
+    g.slow_statements = []
+    g.response_bytes = 0
+
+# Count the bytes of a streamed body as it is sent (JSON and SSE bodies are ASCII)
+def counted_body(body, stats):
+    try:
+        for chunk in body:
+            stats.response_bytes += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+# Per-route latency, size and status metrics. Latency runs until the handler returns; the
+# size of a streamed body, its SQL time and the slow-request log wait until it has been sent.
+@app.after_request
+def record_request(response):
+    stats = g._get_current_object()
+    labels = (('method', request.method), ('route', metric_route()))
+    observe('http_request_duration_seconds', labels, time.perf_counter() - stats.request_start)
+    count('http_responses_total', labels + (('status', str(response.status_code)),))
+    if response.is_streamed and response.content_length is None:
+        response.response = counted_body(response.response, stats)
+    else:
+        stats.response_bytes = response.content_length or 0
+    slow_ms = 0 if response.mimetype == 'text/event-stream' else app.config['SLOW_REQUEST_MS']
+    method, path, status = request.method, request.full_path.rstrip('?'), response.status_code
+
+    def finish():
+        observe('http_response_size_bytes', labels, stats.response_bytes)
+        elapsed = time.perf_counter() - stats.request_start
+        if stats.slow_statements or (slow_ms and elapsed * 1000 >= slow_ms):
+            app.logger.warning('Slow request %s %s -> %d: %.1f ms, %.1f ms SQL in %d statements, %d bytes%s',
+                               method, path, status, elapsed * 1000, stats.sql_seconds * 1000,
+                               stats.sql_statements, stats.response_bytes, format_statements(stats.slow_statements))
+
+    response.call_on_close(finish)
+    return response
+
+# Close every connection this worker opened
+@atexit.register
+def close_db():
+    while _connections:
+        _connections.pop().close()
 
 # Initialize SQLite database
 def init_db():
-    conn = sqlite3.connect('locations.db')
+    conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     # Comment out DROP TABLE after first run to persist data
     # c.execute('DROP TABLE IF EXISTS locations')
@@ -20,9 +343,324 @@ def init_db():
                  days TEXT,
                  time_from TEXT,
                  time_to TEXT)''')
+    # Schedule compiled at write time: weekday bitmask and minute-of-day window
+    columns = {r[1] for r in c.execute('PRAGMA table_info(locations)')}
+    for column in ('day_mask', 'minute_from', 'minute_to'):
+        if column not in columns:
+            c.execute('ALTER TABLE locations ADD COLUMN %s INTEGER' % column)
+    c.execute('CREATE INDEX IF NOT EXISTS locations_schedule ON locations (minute_from, minute_to, day_mask)')
+    c.execute('''CREATE INDEX IF NOT EXISTS locations_schedule_wrap ON locations (minute_to, day_mask)
+                 WHERE minute_from > minute_to''')
+    # Backfill rows written before the columns existed
+    conn.create_function('compile_schedule', 4, compile_schedule_column, deterministic=True)
+    c.execute('''UPDATE locations SET day_mask = compile_schedule(days, time_from, time_to, 0),
+                 minute_from = compile_schedule(days, time_from, time_to, 1),
+                 minute_to = compile_schedule(days, time_from, time_to, 2)
+                 WHERE day_mask IS NULL''')
+    # Integer epoch seconds of the client timestamp, for time-range filters and retention
+    if 'ts' not in columns:
+        c.execute('ALTER TABLE locations ADD COLUMN ts INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS locations_type_ts ON locations (type, ts)')
+    # Keyset pagination in id order within a type for /locations_page
+    c.execute('CREATE INDEX IF NOT EXISTS locations_type_id ON locations (type, id)')
+    conn.create_function('epoch', 1, epoch_column, deterministic=True)
+    c.execute('UPDATE locations SET ts = epoch(timestamp) WHERE ts IS NULL AND timestamp IS NOT NULL')
+    # Number of reports merged into each row in dedup mode
+    if 'report_count' not in columns:
+        c.execute('ALTER TABLE locations ADD COLUMN report_count INTEGER NOT NULL DEFAULT 1')
+    # Per-day, per-cell aggregates of raw points removed by retention
+    c.execute('''CREATE TABLE IF NOT EXISTS location_rollups (
+                 day TEXT, type TEXT, cy INTEGER, cx INTEGER,
+                 count INTEGER NOT NULL, sum_speed REAL NOT NULL, max_speed REAL NOT NULL,
+                 sum_lat REAL NOT NULL, sum_lon REAL NOT NULL,
+                 PRIMARY KEY (day, type, cy, cx)) WITHOUT ROWID''')
+    # R*Tree spatial index over location points, kept in sync by triggers
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree USING rtree(
+                 id, min_lat, max_lat, min_lon, max_lon)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_insert AFTER INSERT ON locations BEGIN
+                 INSERT INTO locations_rtree VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_update AFTER UPDATE OF lat, lon ON locations BEGIN
+                 UPDATE locations_rtree SET min_lat=NEW.lat, max_lat=NEW.lat, min_lon=NEW.lon, max_lon=NEW.lon
+                 WHERE id=NEW.id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_delete AFTER DELETE ON locations BEGIN
+                 DELETE FROM locations_rtree WHERE id=OLD.id;
+                 END''')
+    # Backfill the index for rows written before it existed
+    c.execute('''INSERT INTO locations_rtree
+                 SELECT id, lat, lat, lon, lon FROM locations
+                 WHERE id NOT IN (SELECT id FROM locations_rtree)''')
+    # Change log: latest change version per location id, deletes kept as tombstones
+    c.execute('''CREATE TABLE IF NOT EXISTS location_changes (
+                 location_id INTEGER PRIMARY KEY,
+                 version INTEGER NOT NULL,
+                 deleted INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('CREATE INDEX IF NOT EXISTS location_changes_version ON location_changes (version)')
+    # Retention prunes tombstones below the horizon; readers behind it have to reload
+    c.execute('CREATE INDEX IF NOT EXISTS location_changes_tombstones ON location_changes (version) WHERE deleted = 1')
+    c.execute('CREATE TABLE IF NOT EXISTS location_changes_horizon (version INTEGER NOT NULL)')
+    for event, row, deleted in (('INSERT', 'NEW', 0), ('UPDATE', 'NEW', 0), ('DELETE', 'OLD', 1)):
+        c.execute('''CREATE TRIGGER IF NOT EXISTS location_changes_%s AFTER %s ON locations BEGIN
+                     INSERT OR REPLACE INTO location_changes (location_id, version, deleted)
+                     VALUES (%s.id, (SELECT IFNULL(MAX(version), 0) + 1 FROM location_changes), %d);
+                     END''' % (event.lower(), event, row, deleted))
+    c.execute('''INSERT INTO location_changes (location_id, version)
+                 SELECT id, (SELECT IFNULL(MAX(version), 0) + 1 FROM location_changes) FROM locations
+                 WHERE id NOT IN (SELECT location_id FROM location_changes)''')
+    # Cluster hierarchy: per zoom level, point counts and coordinate sums per grid cell and type
+    c.execute('CREATE TABLE IF NOT EXISTS cluster_levels (zoom INTEGER PRIMARY KEY, cell REAL NOT NULL)')
+    c.execute('''CREATE TABLE IF NOT EXISTS location_clusters (
+                 zoom INTEGER, cx INTEGER, cy INTEGER, type TEXT,
+                 count INTEGER NOT NULL, sum_lat REAL NOT NULL, sum_lon REAL NOT NULL,
+                 PRIMARY KEY (zoom, cx, cy, type)) WITHOUT ROWID''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS location_clusters_insert AFTER INSERT ON locations BEGIN
+                 %s;
+                 END''' % (CLUSTER_ADD_SQL % {'row': 'NEW'}))
+    c.execute('''CREATE TRIGGER IF NOT EXISTS location_clusters_update AFTER UPDATE OF type, lat, lon ON locations BEGIN
+                 %s;
+                 %s;
+                 END''' % (CLUSTER_REMOVE_SQL % {'row': 'OLD'}, CLUSTER_ADD_SQL % {'row': 'NEW'}))
+    c.execute('''CREATE TRIGGER IF NOT EXISTS location_clusters_delete AFTER DELETE ON locations BEGIN
+                 %s;
+                 END''' % (CLUSTER_REMOVE_SQL % {'row': 'OLD'}))
+    levels = [(z, cluster_cell(z)) for z in range(app.config['CLUSTER_MIN_ZOOM'], app.config['CLUSTER_MAX_ZOOM'] + 1)]
+    if c.execute('SELECT zoom, cell FROM cluster_levels ORDER BY zoom').fetchall() != levels:
+        rebuild_clusters(conn, levels)
+    # Speed statistics per grid cell, type and local hour of week
+    c.execute('CREATE TABLE IF NOT EXISTS speed_stats_grid (cell REAL NOT NULL, utc_offset INTEGER NOT NULL)')
+    c.execute('''CREATE TABLE IF NOT EXISTS speed_stats (
+                 type TEXT, cy INTEGER, cx INTEGER, how INTEGER,
+                 count INTEGER NOT NULL, sum_speed REAL NOT NULL, sum_sq REAL NOT NULL,
+                 min_speed REAL NOT NULL, max_speed REAL NOT NULL,
+                 PRIMARY KEY (type, cy, cx, how)) WITHOUT ROWID''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS speed_stats_insert AFTER INSERT ON locations BEGIN
+                 %s;
+                 END''' % (SPEED_STATS_ADD_SQL % {'row': 'NEW'}))
+    c.execute('''CREATE TRIGGER IF NOT EXISTS speed_stats_update AFTER UPDATE OF type, lat, lon, speed, ts ON locations BEGIN
+                 %s;
+                 %s;
+                 END''' % (SPEED_STATS_REMOVE_SQL % {'row': 'OLD'}, SPEED_STATS_ADD_SQL % {'row': 'NEW'}))
+    c.execute('''CREATE TRIGGER IF NOT EXISTS speed_stats_delete AFTER DELETE ON locations BEGIN
+                 %s;
+                 END''' % (SPEED_STATS_REMOVE_SQL % {'row': 'OLD'}))
+    if c.execute('SELECT cell, utc_offset FROM speed_stats_grid').fetchall() != [speed_stats_grid()]:
+        rebuild_speed_stats(conn)
     conn.commit()
     conn.close()
 
+# Grid cell index of a point for a cluster level; %(row)s is NEW or OLD inside triggers
+CLUSTER_CELL_SQL = ('CAST((%(row)s.lon + 180) / cell AS INTEGER), '
+                    'CAST((%(row)s.lat + 90) / cell AS INTEGER)')
+CLUSTER_ADD_SQL = ('''INSERT INTO location_clusters (zoom, cx, cy, type, count, sum_lat, sum_lon)
+                      SELECT zoom, %s, %%(row)s.type, 1, %%(row)s.lat, %%(row)s.lon FROM cluster_levels WHERE true
+                      ON CONFLICT (zoom, cx, cy, type) DO UPDATE SET
+                      count = count + 1, sum_lat = sum_lat + excluded.sum_lat, sum_lon = sum_lon + excluded.sum_lon'''
+                   % CLUSTER_CELL_SQL)
+CLUSTER_REMOVE_SQL = ('''UPDATE location_clusters
+                         SET count = count - 1, sum_lat = sum_lat - %%(row)s.lat, sum_lon = sum_lon - %%(row)s.lon
+                         WHERE (zoom, cx, cy, type) IN (SELECT zoom, %s, %%(row)s.type FROM cluster_levels);
+                         DELETE FROM location_clusters
+                         WHERE (zoom, cx, cy, type) IN (SELECT zoom, %s, %%(row)s.type FROM cluster_levels)
+                         AND count <= 0''' % (CLUSTER_CELL_SQL, CLUSTER_CELL_SQL))
+
+# Width in degrees of a cluster cell at a zoom level
+def cluster_cell(zoom):
+    return app.config['CLUSTER_CELL_PX'] * 360.0 / (256 * 2 ** zoom)
+
+# Recompute the whole cluster hierarchy from the locations table
+def rebuild_clusters(conn, levels):
+    conn.execute('DELETE FROM cluster_levels')
+    conn.executemany('INSERT INTO cluster_levels (zoom, cell) VALUES (?, ?)', levels)
+    conn.execute('DELETE FROM location_clusters')
+    conn.execute('''INSERT INTO location_clusters (zoom, cx, cy, type, count, sum_lat, sum_lon)
+                    SELECT zoom, %s, type, COUNT(*), SUM(lat), SUM(lon)
+                    FROM cluster_levels, locations l
+                    GROUP BY 1, 2, 3, 4''' % (CLUSTER_CELL_SQL % {'row': 'l'}))
+
+# Key of a point in speed_stats: grid cell, type and hour of week in SCHEDULE_TIMEZONE (0 is
+# Monday 00:00, -1 without a timestamp). The zone's UTC offset is fixed when the table is built,
+# so during daylight saving time hours are off by one. %(row)s is NEW, OLD or a table alias.
+SPEED_STATS_KEY_SQL = ('%(row)s.type, CAST((%(row)s.lat + 90) / cell AS INTEGER), '
+                       'CAST((%(row)s.lon + 180) / cell AS INTEGER), '
+                       'IFNULL((((%(row)s.ts + utc_offset) / 3600 + 72) %% 168 + 168) %% 168, -1)')
+SPEED_STATS_ADD_SQL = ('''INSERT INTO speed_stats (type, cy, cx, how, count, sum_speed, sum_sq, min_speed, max_speed)
+                          SELECT %s, 1, %%(row)s.speed, %%(row)s.speed * %%(row)s.speed, %%(row)s.speed, %%(row)s.speed
+                          FROM speed_stats_grid WHERE %%(row)s.speed IS NOT NULL
+                          ON CONFLICT (type, cy, cx, how) DO UPDATE SET
+                          count = count + 1, sum_speed = sum_speed + excluded.sum_speed, sum_sq = sum_sq + excluded.sum_sq,
+                          min_speed = MIN(min_speed, excluded.min_speed), max_speed = MAX(max_speed, excluded.max_speed)'''
+                       % SPEED_STATS_KEY_SQL)
+# The same key as equality conditions on speed_stats; inside triggers a row-value IN over
+# speed_stats_grid is planned as a scan of speed_stats
+SPEED_STATS_MATCH_SQL = ('type = %(row)s.type '
+                         'AND cy = CAST((%(row)s.lat + 90) / (SELECT cell FROM speed_stats_grid) AS INTEGER) '
+                         'AND cx = CAST((%(row)s.lon + 180) / (SELECT cell FROM speed_stats_grid) AS INTEGER) '
+                         'AND how = IFNULL((((%(row)s.ts + (SELECT utc_offset FROM speed_stats_grid)) / 3600 + 72) '
+                         '%% 168 + 168) %% 168, -1)')
+# Removing a cell's minimum or maximum rescans that cell through the R*Tree, widened by a
+# cell on each side against its single-precision boxes; the key check on l is exact.
+# CROSS JOIN keeps the planner from driving the rescan through locations_type_ts instead.
+SPEED_STATS_REMOVE_SQL = ('''UPDATE speed_stats
+                             SET count = count - 1, sum_speed = sum_speed - %%(row)s.speed,
+                             sum_sq = sum_sq - %%(row)s.speed * %%(row)s.speed
+                             WHERE %(match)s AND %%(row)s.speed IS NOT NULL;
+                             DELETE FROM speed_stats WHERE %(match)s AND count <= 0;
+                             UPDATE speed_stats SET (min_speed, max_speed) = (
+                                 SELECT MIN(l.speed), MAX(l.speed)
+                                 FROM speed_stats_grid CROSS JOIN locations_rtree r CROSS JOIN locations l ON l.id = r.id
+                                 WHERE r.min_lat >= (speed_stats.cy - 1) * cell - 90
+                                 AND r.max_lat <= (speed_stats.cy + 2) * cell - 90
+                                 AND r.min_lon >= (speed_stats.cx - 1) * cell - 180
+                                 AND r.max_lon <= (speed_stats.cx + 2) * cell - 180
+                                 AND l.speed IS NOT NULL
+                                 AND (%(l_key)s) = (speed_stats.type, speed_stats.cy, speed_stats.cx, speed_stats.how))
+                             WHERE %(match)s AND (%%(row)s.speed <= min_speed OR %%(row)s.speed >= max_speed)'''
+                          % {'match': SPEED_STATS_MATCH_SQL, 'l_key': SPEED_STATS_KEY_SQL.replace('%(row)s', 'l')})
+
+# (cell size, UTC offset in seconds) the speed_stats keys are computed with
+def speed_stats_grid():
+    offset = datetime.now(ZoneInfo(app.config['SCHEDULE_TIMEZONE'])).utcoffset()
+    return app.config['SPEED_STATS_CELL_DEG'], int(offset.total_seconds())
+
+# Recompute speed_stats from the locations table, with the current grid
+def rebuild_speed_stats(conn):
+    conn.execute('DELETE FROM speed_stats_grid')
+    conn.execute('INSERT INTO speed_stats_grid (cell, utc_offset) VALUES (?, ?)', speed_stats_grid())
+    conn.execute('DELETE FROM speed_stats')
+    conn.execute('''INSERT INTO speed_stats (type, cy, cx, how, count, sum_speed, sum_sq, min_speed, max_speed)
+                    SELECT %s, COUNT(*), SUM(speed), SUM(speed * speed), MIN(speed), MAX(speed)
+                    FROM speed_stats_grid, locations l WHERE speed IS NOT NULL
+                    GROUP BY 1, 2, 3, 4''' % (SPEED_STATS_KEY_SQL % {'row': 'l'}))
+
+# Minute of day of an 'HH:MM' time
+def parse_minute(value):
+    m = re.fullmatch(r'(\d{1,2}):(\d{2})(?::\d{2})?', value)
+    if not m or int(m[1]) > 23 or int(m[2]) > 59:
+        raise ValueError('Invalid time: %s' % value)
+    return int(m[1]) * 60 + int(m[2])
+
+# Compile a schedule into (weekday bitmask, first minute, last minute), bit 0 being Monday.
+# An unset schedule is always active; a window with from > to wraps past midnight.
+def compile_schedule(days, time_from, time_to):
+    if not days or days == 'Everyday':
+        mask = ALL_DAYS
+    else:
+        mask = 0
+        for day in days.split(','):
+            if day.strip() not in DAYS_OF_WEEK:
+                raise ValueError('Invalid day: %s' % day)
+            mask |= 1 << DAYS_OF_WEEK.index(day.strip())
+    if not time_from and not time_to:
+        return mask, 0, 1439
+    return mask, parse_minute(time_from or '00:00'), parse_minute(time_to or '23:59')
+
+# One compiled schedule column, as an SQL function for backfills.
+# Unparsable legacy schedules get an empty day mask and are never active.
+def compile_schedule_column(days, time_from, time_to, index):
+    try:
+        return compile_schedule(days, time_from, time_to)[index]
+    except ValueError:
+        return (0, 0, 1439)[index]
+
+# Epoch seconds of an ISO 8601 time or a number of seconds (milliseconds when it is too large
+# to be seconds, as from Date.now()). Naive ISO times are taken as SCHEDULE_TIMEZONE.
+def parse_epoch(value):
+    if isinstance(value, str) and re.fullmatch(r'\s*-?\d+(\.\d+)?\s*', value):
+        value = float(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if not math.isfinite(value):
+            raise ValueError('Invalid timestamp: %s' % value)
+        return math.floor(value / 1000 if abs(value) >= 1e11 else value)
+    if not isinstance(value, str):
+        raise ValueError('Invalid timestamp: %r' % (value,))
+    at = datetime.fromisoformat(value.strip())
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=ZoneInfo(app.config['SCHEDULE_TIMEZONE']))
+    return math.floor(at.timestamp())
+
+# parse_epoch as an SQL function for backfills; unparsable legacy timestamps stay NULL
+def epoch_column(value):
+    try:
+        return parse_epoch(value)
+    except ValueError:
+        return None
+
+# Local wall-clock moment for schedule checks as (datetime, weekday, minute of day).
+# Aware ISO values are converted to SCHEDULE_TIMEZONE, naive ones are taken as local.
+def schedule_moment(value=None):
+    zone = ZoneInfo(app.config['SCHEDULE_TIMEZONE'])
+    at = datetime.fromisoformat(value) if value else datetime.now(zone)
+    if at.tzinfo:
+        at = at.astimezone(zone)
+    return at, at.weekday(), at.hour * 60 + at.minute
+
+# Slippy-map tile containing a point at zoom z
+def lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+# North-west corner of a slippy-map tile as (lon, lat)
+def tile_to_lonlat(x, y, z):
+    n = 2 ** z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+# Parse a Leaflet bbox string "west,south,east,north"; with a zoom the box is
+# snapped outwards to whole tiles so small pans map to the same query
+def parse_bbox(value, zoom=None):
+    west, south, east, north = (float(v) for v in value.split(','))
+    if not (west <= east and south <= north):
+        raise ValueError('Invalid bbox')
+    if zoom is not None:
+        x0, y0 = lonlat_to_tile(west, north, zoom)
+        x1, y1 = lonlat_to_tile(east, south, zoom)
+        west, north = tile_to_lonlat(x0, y0, zoom)
+        east, south = tile_to_lonlat(x1 + 1, y1 + 1, zoom)
+    return west, south, east, north
+
+# The R*Tree stores single-precision boxes rounded outwards, so a point within one float32 step
+# of a query edge can have a box poking past it. R*Tree bounds are widened by this much and the
+# exact test is left to the conditions on l.
+RTREE_EPS_DEG = 1e-4
+
+# Build the FROM/WHERE part of a locations query from bbox, zoom, type and from/to filters.
+# With since, rows are driven from the change log so the cost follows the number of changes.
+# Without rtree the bbox is only tested on l. Extra conditions on l can be passed in where/params.
+def location_filter(args, since=None, where=(), params=(), rtree=True):
+    where, params = list(where), list(params)
+    if since is not None:
+        sql = ' FROM location_changes c CROSS JOIN locations l ON l.id = c.location_id'
+        where.append('c.version > ?')
+        params.append(since)
+    else:
+        sql = ' FROM locations l'
+    if args.get('bbox'):
+        west, south, east, north = parse_bbox(args['bbox'], args.get('zoom', type=int))
+        if since is None and rtree:
+            sql += ' JOIN locations_rtree r ON r.id = l.id'
+            where += ['r.min_lat >= ?', 'r.max_lat <= ?', 'r.min_lon >= ?', 'r.max_lon <= ?']
+            params += [south - RTREE_EPS_DEG, north + RTREE_EPS_DEG, west - RTREE_EPS_DEG, east + RTREE_EPS_DEG]
+        where += ['l.lat BETWEEN ? AND ?', 'l.lon BETWEEN ? AND ?']
+        params += [south, north, west, east]
+    if args.get('type'):
+        types = [t for t in args['type'].split(',') if t]
+        where.append('l.type IN (%s)' % ','.join('?' * len(types)))
+        params += types
+    # Inclusive time range on the epoch column; with a type filter it is served by locations_type_ts
+    if args.get('from'):
+        where.append('l.ts >= ?')
+        params.append(parse_epoch(args['from']))
+    if args.get('to'):
+        where.append('l.ts <= ?')
+        params.append(parse_epoch(args['to']))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql, params
+
 # HTML template with Tailwind CSS, FontAwesome, and OpenStreetMap
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -31,11 +669,16 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Tanjore District Dashboard</title>
+{% if assets %}
+    {% for href in assets.css %}<link rel="stylesheet" href="{{ href }}">
+    {% endfor %}<script type="module" src="{{ assets.js }}"></script>
+{% else %}
     <script src="https://cdn.tailwindcss.com"></script>
     <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
     <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">
     <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap" rel="stylesheet">
+{% endif %}
     <style>
         body { 
             background-color: #121212; 
@@ -89,18 +732,6 @@ HTML_TEMPLATE = '''
         .alert.success { border-left-color: #4caf50; }
         .alert.error { border-left-color: #f44336; }
         @keyframes slideIn { from { transform: translateX(100%); opacity: 0; } to { transform: translateX(0); opacity: 1; } }
-        .custom-icon { 
-            background: #2d2d2d; 
-            border-radius: 50%; 
-            width: 28px; 
-            height: 28px; 
-            display: flex; 
-            align-items: center; 
-            justify-content: center; 
-            color: #42a5f5; 
-            font-size: 14px; 
-            border: 1px solid #424242; 
-        }
         .input-field { 
             background-color: #252525; 
             border: 1px solid #424242; 
@@ -192,16 +823,22 @@ HTML_TEMPLATE = '''
     <script>
         let map;
         let markingEnabled = false;
+        let dataVersion = null;
+        let eventSource = null;
+        let lastEventId = '';
         const markers = {};
         const daysOfWeek = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'];
+        const LIST_PAGE_SIZE = 100;
+        let listAfterId = 0;
+        let listLoading = false;
+        let listRequest = 0;
+        let listTimer = null;
 
-        // Custom FontAwesome-based icons
-        const icons = {
-            accidents: L.divIcon({ className: 'custom-icon', html: '<i class="fas fa-exclamation-triangle"></i>', iconSize: [28, 28], iconAnchor: [14, 28], popupAnchor: [0, -28] }),
-            crowded: L.divIcon({ className: 'custom-icon', html: '<i class="fas fa-users"></i>', iconSize: [28, 28], iconAnchor: [14, 28], popupAnchor: [0, -28] }),
-            hospitals: L.divIcon({ className: 'custom-icon', html: '<i class="fas fa-hospital"></i>', iconSize: [28, 28], iconAnchor: [14, 28], popupAnchor: [0, -28] }),
-            schools: L.divIcon({ className: 'custom-icon', html: '<i class="fas fa-school"></i>', iconSize: [28, 28], iconAnchor: [14, 28], popupAnchor: [0, -28] })
-        };
+        // Markers are circles drawn on one shared canvas rather than a DOM node each. The renderer
+        // is created in initMap since the self-hosted Leaflet bundle is a module script that only
+        // runs once the document has been parsed.
+        const markerColors = { accidents: '#ef5350', crowded: '#ffa726', hospitals: '#66bb6a', schools: '#42a5f5' };
+        let renderer;
 
         // Show alert
         function showAlert(message, type = 'success') {
@@ -214,12 +851,15 @@ HTML_TEMPLATE = '''
 
         // Initialize map
         function initMap() {
+            renderer = L.canvas({ padding: 0.5 });
             map = L.map('map', {
                 center: [10.7860, 79.1378],
                 zoom: 10,
                 minZoom: 10,
                 maxBounds: [[10.05, 78.8], [11.2, 79.7]],
-                maxBoundsViscosity: 1.0
+                maxBoundsViscosity: 1.0,
+                preferCanvas: true,
+                renderer: renderer
             });
 
             L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
@@ -227,12 +867,25 @@ HTML_TEMPLATE = '''
                 maxZoom: 18
             }).addTo(map);
 
+            // Fetch the next list page when the sidebar is scrolled near its end
+            document.getElementById('sidebar').addEventListener('scroll', e => {
+                const sidebar = e.target;
+                if (sidebar.scrollTop + sidebar.clientHeight >= sidebar.scrollHeight - 200) {
+                    loadListPage();
+                }
+            });
+
+            subscribeEvents();
             loadLocations();
+            map.on('moveend', () => {
+                subscribeEvents();
+                loadLocations();
+            });
             map.on('click', function(e) {
                 if (markingEnabled) {
                     const type = document.getElementById('locationType').value;
                     const speed = document.getElementById('speed').value;
-                    addMarker(e.latlng.lat, e.latlng.lng, type, speed);
+                    const pendingId = addMarker(e.latlng.lat, e.latlng.lng, type, speed, new Date().toISOString());
                     fetch('/add_location', {
                         method: 'POST',
                         headers: {'Content-Type': 'application/json'},
@@ -248,10 +901,19 @@ HTML_TEMPLATE = '''
                         })
                     }).then(response => response.json())
                       .then(data => {
-                          if (data.status === 'success') {
+                          if (data.status === 'queued') {
+                              // Written in the background; pick it up once its batch is committed
+                              showAlert('Location queued', 'success');
+                              setTimeout(() => { removeMarker(pendingId); refreshAfterWrite(); }, 500);
+                              return;
+                          }
+                          removeMarker(pendingId);
+                          if (data.merged_into) {
+                              showAlert(`Merged into a nearby report (${data.report_count} reports)`, 'success');
+                          } else if (data.status === 'success') {
                               showAlert('Location added successfully', 'success');
-                              loadLocations();
                           }
+                          refreshAfterWrite();
                       });
                     markingEnabled = false;
                     map.getContainer().style.cursor = '';
@@ -283,25 +945,106 @@ HTML_TEMPLATE = '''
             map.invalidateSize();
         }
 
-        // Load locations
+        // Load locations inside the current viewport
         function loadLocations() {
-            fetch('/get_locations')
+            const params = new URLSearchParams({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() });
+            fetch(`/get_locations?${params}`)
+                .then(response => {
+                    dataVersion = response.headers.get('X-Data-Version');
+                    return response.json();
+                })
+                .then(data => {
+                    Object.keys(markers).forEach(removeMarker);
+                    data.forEach(loc => addMarker(loc.lat, loc.lon, loc.type, loc.speed, loc.timestamp, loc.id, loc.days, loc.time_from, loc.time_to, loc.report_count));
+                    updateLocationsList();
+                });
+        }
+
+        // Apply changes made since the last load instead of reloading everything
+        function syncLocations() {
+            if (dataVersion === null) {
+                loadLocations();
+                return;
+            }
+            const params = new URLSearchParams({ since: dataVersion, bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() });
+            fetch(`/get_locations?${params}`)
                 .then(response => response.json())
                 .then(data => {
-                    Object.keys(markers).forEach(id => map.removeLayer(markers[id].marker));
-                    Object.assign(markers, {});
-                    data.forEach(loc => addMarker(loc.lat, loc.lon, loc.type, loc.speed, loc.timestamp, loc.id, loc.days, loc.time_from, loc.time_to));
+                    if (data.reset) {
+                        loadLocations();
+                        return;
+                    }
+                    data.deleted.forEach(removeMarker);
+                    data.changes.forEach(loc => {
+                        removeMarker(loc.id);
+                        addMarker(loc.lat, loc.lon, loc.type, loc.speed, loc.timestamp, loc.id, loc.days, loc.time_from, loc.time_to, loc.report_count);
+                    });
+                    dataVersion = data.version;
                     updateLocationsList();
                 });
         }
 
-        // Add marker
-        function addMarker(lat, lon, type, speed, timestamp, id = null, days = '', time_from = '', time_to = '') {
+        // Subscribe to live changes inside the current viewport, resuming after the last event seen
+        function subscribeEvents() {
+            if (!window.EventSource) return;
+            if (eventSource) eventSource.close();
+            const params = new URLSearchParams({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() });
+            if (lastEventId) params.set('last_event_id', lastEventId);
+            eventSource = new EventSource(`/events?${params}`);
+            eventSource.onmessage = e => {
+                lastEventId = e.lastEventId;
+                const change = JSON.parse(e.data);
+                if (change.op === 'reset') {
+                    loadLocations();
+                    return;
+                }
+                removeMarker(change.id);
+                if (change.op !== 'delete') {
+                    addMarker(change.lat, change.lon, change.type, change.speed, change.timestamp, change.id, change.days, change.time_from, change.time_to, change.report_count);
+                }
+                updateLocationsList();
+            };
+        }
+
+        // Pick up our own write; a connected event stream delivers it already
+        function refreshAfterWrite() {
+            if (!eventSource || eventSource.readyState !== EventSource.OPEN) {
+                syncLocations();
+            }
+        }
+
+        // Remove a marker from the map
+        function removeMarker(id) {
+            if (markers[id]) {
+                map.removeLayer(markers[id].marker);
+                delete markers[id];
+            }
+        }
+
+        // Add marker; its popup content is built when the popup opens
+        function addMarker(lat, lon, type, speed, timestamp, id = null, days = '', time_from = '', time_to = '', report_count = 1) {
+            const markerId = id || Date.now();
+            const marker = L.circleMarker([lat, lon], {
+                renderer: renderer, radius: 7, color: '#1e1e1e', weight: 1, fillColor: markerColors[type], fillOpacity: 0.9
+            }).addTo(map);
+            marker.bindPopup(() => popupContent(markerId));
+
+            marker.on('popupopen', function() {
+                const popup = marker.getPopup();
+                L.DomEvent.addListener(popup._contentNode, 'click', L.DomEvent.stopPropagation);
+            });
+
+            markers[markerId] = { marker, lat, lon, type, speed, timestamp, days, time_from, time_to, report_count, id };
+            return markerId;
+        }
+
+        // Popup HTML for a marker, from its current data
+        function popupContent(markerId) {
+            const { lat, lon, type, speed, timestamp, days, time_from, time_to, report_count } = markers[markerId];
             const displayTime = new Date(timestamp).toLocaleString('en-US', { 
                 weekday: 'long', year: 'numeric', month: 'long', day: 'numeric', hour: '2-digit', minute: '2-digit' 
             });
-            const markerId = id || Date.now();
-            const marker = L.marker([lat, lon], { icon: icons[type] }).addTo(map);
+            const anytime = time_from === '00:00' && time_to === '23:59';
 
             const dayCheckboxes = daysOfWeek.map(day => `
                 <label class="icon-text mb-1">
@@ -309,7 +1052,7 @@ HTML_TEMPLATE = '''
                 </label>
             `).join('');
 
-            marker.bindPopup(`
+            return `
                 <div class="popup-content">
                     <div class="flex mb-3">
                         <span class="tab-button active" onclick="switchTab('info', ${markerId})"><i class="fas fa-info-circle"></i></span>
@@ -317,12 +1060,13 @@ HTML_TEMPLATE = '''
                     </div>
                     <div id="info_${markerId}" class="tab active">
                         <p class="icon-text"><i class="fas fa-layer-group"></i>Type: ${type}</p>
+                        ${report_count > 1 ? `<p class="icon-text"><i class="fas fa-users"></i>${report_count} reports</p>` : ''}
                         <p class="icon-text"><i class="fas fa-tachometer-alt"></i>Speed: <input type="number" id="editSpeed${markerId}" value="${speed}" step="0.1" min="0" class="input-field w-16 inline"> km/h</p>
                         <p class="icon-text"><i class="fas fa-map-marker-alt"></i>Lat: ${lat.toFixed(4)}</p>
                         <p class="icon-text"><i class="fas fa-long-arrow-alt-right"></i>Lon: ${lon.toFixed(4)}</p>
                         <p class="icon-text"><i class="fas fa-calendar-alt"></i>${displayTime}</p>
                         <div class="mt-3 flex gap-2">
-                            <button onclick="updateMarker(${markerId}, ${lat}, ${lon}, '${type}')" class="btn"><i class="fas fa-save"></i>Save</button>
+                            <button onclick="updateMarker(${markerId})" class="btn"><i class="fas fa-save"></i>Save</button>
                             <button onclick="deleteMarker(${markerId})" class="btn btn-danger"><i class="fas fa-trash"></i>Delete</button>
                         </div>
                     </div>
@@ -333,25 +1077,17 @@ HTML_TEMPLATE = '''
                         </label>
                         ${dayCheckboxes}
                         <label class="icon-text mb-2">
-                            <input type="checkbox" id="anytime_${markerId}" ${time_from === '00:00' && time_to === '23:59' ? 'checked' : ''} onchange="toggleAnytime(${markerId})" class="mr-2"> Anytime
+                            <input type="checkbox" id="anytime_${markerId}" ${anytime ? 'checked' : ''} onchange="toggleAnytime(${markerId})" class="mr-2"> Anytime
                         </label>
-                        <p class="icon-text"><i class="fas fa-hourglass-start"></i>From: <input type="time" id="timeFrom${markerId}" value="${time_from}" class="input-field w-24 ${time_from === '00:00' && time_to === '23:59' ? 'opacity-50' : ''}" ${time_from === '00:00' && time_to === '23:59' ? 'disabled' : ''}></p>
-                        <p class="icon-text"><i class="fas fa-hourglass-end"></i>To: <input type="time" id="timeTo${markerId}" value="${time_to}" class="input-field w-24 ${time_from === '00:00' && time_to === '23:59' ? 'opacity-50' : ''}" ${time_from === '00:00' && time_to === '23:59' ? 'disabled' : ''}></p>
+                        <p class="icon-text"><i class="fas fa-hourglass-start"></i>From: <input type="time" id="timeFrom${markerId}" value="${time_from}" class="input-field w-24 ${anytime ? 'opacity-50' : ''}" ${anytime ? 'disabled' : ''}></p>
+                        <p class="icon-text"><i class="fas fa-hourglass-end"></i>To: <input type="time" id="timeTo${markerId}" value="${time_to}" class="input-field w-24 ${anytime ? 'opacity-50' : ''}" ${anytime ? 'disabled' : ''}></p>
                         <div class="mt-3 flex gap-2">
-                            <button onclick="saveDayTime(${markerId}, ${lat}, ${lon}, '${type}')" class="btn"><i class="fas fa-check"></i>Apply</button>
+                            <button onclick="saveDayTime(${markerId})" class="btn"><i class="fas fa-check"></i>Apply</button>
                             <button onclick="clearDayTime(${markerId})" class="btn btn-secondary"><i class="fas fa-times"></i>Clear</button>
                         </div>
                     </div>
                 </div>
-            `);
-
-            marker.on('popupopen', function() {
-                const popup = marker.getPopup();
-                L.DomEvent.addListener(popup._contentNode, 'click', L.DomEvent.stopPropagation);
-            });
-
-            markers[markerId] = { marker, lat, lon, type, speed, timestamp, days, time_from, time_to, id };
-            updateLocationsList();
+            `;
         }
 
         // Toggle Everyday
@@ -405,37 +1141,32 @@ HTML_TEMPLATE = '''
         }
 
         // Update marker speed
-        function updateMarker(id, lat, lon, type) {
+        function updateMarker(id) {
             const newSpeed = document.getElementById(`editSpeed${id}`).value;
             if (!newSpeed) {
                 showAlert('Please enter a speed', 'error');
                 return;
             }
-            fetch('/update_location', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    id: markers[id].id,
-                    lat: lat,
-                    lon: lon,
-                    type: type,
-                    speed: newSpeed,
-                    timestamp: markers[id].timestamp,
-                    days: markers[id].days,
-                    time_from: markers[id].time_from,
-                    time_to: markers[id].time_to
-                })
-            }).then(response => response.json())
+            patchLocation(id, { speed: newSpeed })
               .then(data => {
                   if (data.status === 'success') {
                       showAlert('Speed updated', 'success');
-                      loadLocations();
+                      refreshAfterWrite();
                   }
               });
         }
 
+        // Send only the changed fields of a saved marker
+        function patchLocation(id, fields) {
+            return fetch(`/locations/${markers[id].id}`, {
+                method: 'PATCH',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(fields)
+            }).then(response => response.json());
+        }
+
         // Save day and time
-        function saveDayTime(id, lat, lon, type) {
+        function saveDayTime(id) {
             const everydayCheckbox = document.getElementById(`everyday_${id}`);
             const anytimeCheckbox = document.getElementById(`anytime_${id}`);
             let selectedDays = everydayCheckbox.checked ? 'Everyday' : daysOfWeek.filter(day => document.getElementById(`day_${day}_${id}`).checked).join(',');
@@ -447,25 +1178,11 @@ HTML_TEMPLATE = '''
                 timeTo = '23:59';
             }
 
-            fetch('/update_location', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    id: markers[id].id,
-                    lat: lat,
-                    lon: lon,
-                    type: type,
-                    speed: markers[id].speed,
-                    timestamp: markers[id].timestamp,
-                    days: selectedDays,
-                    time_from: timeFrom,
-                    time_to: timeTo
-                })
-            }).then(response => response.json())
+            patchLocation(id, { days: selectedDays, time_from: timeFrom, time_to: timeTo })
               .then(data => {
                   if (data.status === 'success') {
                       showAlert('Schedule updated', 'success');
-                      loadLocations();
+                      refreshAfterWrite();
                   } else {
                       showAlert('Update failed', 'error');
                   }
@@ -474,25 +1191,11 @@ HTML_TEMPLATE = '''
 
         // Clear day and time
         function clearDayTime(id) {
-            fetch('/update_location', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    id: markers[id].id,
-                    lat: markers[id].lat,
-                    lon: markers[id].lon,
-                    type: markers[id].type,
-                    speed: markers[id].speed,
-                    timestamp: markers[id].timestamp,
-                    days: '',
-                    time_from: '',
-                    time_to: ''
-                })
-            }).then(response => response.json())
+            patchLocation(id, { days: '', time_from: '', time_to: '' })
               .then(data => {
                   if (data.status === 'success') {
                       showAlert('Schedule cleared', 'success');
-                      loadLocations();
+                      refreshAfterWrite();
                   }
               });
         }
@@ -511,30 +1214,62 @@ HTML_TEMPLATE = '''
               .then(data => {
                   if (data.status === 'success') {
                       showAlert('Location deleted', 'success');
-                      loadLocations();
+                      refreshAfterWrite();
                   }
               });
         }
 
-        // Update locations list
+        // Sidebar card for a location
+        function locationCard(loc) {
+            const displayTime = new Date(loc.timestamp).toLocaleString('en-US', { 
+                weekday: 'long', year: 'numeric', month: 'long', day: 'numeric', hour: '2-digit', minute: '2-digit' 
+            });
+            return `
+                <div class="location-card">
+                    <p class="icon-text"><i class="fas fa-layer-group"></i>${loc.type}</p>
+                    ${loc.report_count > 1 ? `<p class="icon-text"><i class="fas fa-users"></i>${loc.report_count} reports</p>` : ''}
+                    <p class="icon-text"><i class="fas fa-map-marker-alt"></i>Lat: ${loc.lat.toFixed(4)}, Lon: ${loc.lon.toFixed(4)}</p>
+                    <p class="icon-text"><i class="fas fa-tachometer-alt"></i>${loc.speed} km/h</p>
+                    <p class="icon-text"><i class="fas fa-calendar-alt"></i>${displayTime}</p>
+                    <p class="icon-text"><i class="fas fa-calendar-day"></i>${loc.days || 'None'}</p>
+                    <p class="icon-text"><i class="fas fa-clock"></i>${loc.time_from && loc.time_to ? `${loc.time_from} - ${loc.time_to}` : 'Not set'}</p>
+                </div>
+            `;
+        }
+
+        // Reload the sidebar list for the viewport once a burst of changes has settled, keeping
+        // as many cards as are shown so the scroll position survives
         function updateLocationsList() {
-            const list = document.getElementById('locationsList');
-            list.innerHTML = '';
-            Object.values(markers).forEach(loc => {
-                const displayTime = new Date(loc.timestamp).toLocaleString('en-US', { 
-                    weekday: 'long', year: 'numeric', month: 'long', day: 'numeric', hour: '2-digit', minute: '2-digit' 
+            clearTimeout(listTimer);
+            listTimer = setTimeout(() => {
+                const shown = document.getElementById('locationsList').childElementCount;
+                listAfterId = 0;
+                loadListPage(Math.min(Math.max(shown, LIST_PAGE_SIZE), 1000), true);
+            }, 200);
+        }
+
+        // Fetch the list page after listAfterId from /locations_page and render it in one DOM update
+        function loadListPage(limit = LIST_PAGE_SIZE, replace = false) {
+            if (listAfterId === null || (listLoading && !replace)) return;
+            listLoading = true;
+            const request = ++listRequest;
+            const params = new URLSearchParams({ bbox: map.getBounds().toBBoxString(), after_id: listAfterId, limit: limit });
+            fetch(`/locations_page?${params}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (request !== listRequest) return;
+                    const list = document.getElementById('locationsList');
+                    const html = data.locations.map(locationCard).join('');
+                    if (replace) {
+                        list.innerHTML = html;
+                    } else {
+                        list.insertAdjacentHTML('beforeend', html);
+                    }
+                    listAfterId = data.next_after_id;
+                })
+                .finally(() => {
+                    if (request === listRequest) listLoading = false;
                 });
-                list.innerHTML += `
-                    <div class="location-card">
-                        <p class="icon-text"><i class="fas fa-layer-group"></i>${loc.type}</p>
-                        <p class="icon-text"><i class="fas fa-map-marker-alt"></i>Lat: ${loc.lat.toFixed(4)}, Lon: ${loc.lon.toFixed(4)}</p>
-                        <p class="icon-text"><i class="fas fa-tachometer-alt"></i>${loc.speed} km/h</p>
-                        <p class="icon-text"><i class="fas fa-calendar-alt"></i>${displayTime}</p>
-                        <p class="icon-text"><i class="fas fa-calendar-day"></i>${loc.days || 'None'}</p>
-                        <p class="icon-text"><i class="fas fa-clock"></i>${loc.time_from && loc.time_to ? `${loc.time_from} - ${loc.time_to}` : 'Not set'}</p>
-                    </div>
-                `;
-            });
         }
 
         document.addEventListener('DOMContentLoaded', initMap);
@@ -543,52 +1278,1982 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# Current change version; every insert, update and delete on locations increments it
+def data_version(conn):
+    return conn.execute('SELECT IFNULL(MAX(version), 0) FROM location_changes').fetchone()[0]
+
+# Oldest change-log version readers can catch up from; tombstones below it may be pruned
+def change_horizon(conn):
+    return conn.execute('SELECT IFNULL(MAX(version), 0) FROM location_changes_horizon').fetchone()[0]
+
+# Validate a posted location and return it as an INSERT_LOCATION_SQL parameter tuple
+def location_row(data):
+    if not isinstance(data, dict):
+        raise ValueError('Location must be an object')
+    if data.get('type') not in LOCATION_TYPES:
+        raise ValueError('Invalid type')
+    try:
+        lat, lon, speed = float(data['lat']), float(data['lon']), float(data['speed'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('lat, lon and speed must be numbers')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('Coordinates out of range')
+    if not 0 <= speed < float('inf'):
+        raise ValueError('Invalid speed')
+    timestamp = data.get('timestamp') or datetime.now(timezone.utc).isoformat()
+    try:
+        ts = parse_epoch(timestamp)
+    except (ValueError, OverflowError):
+        raise ValueError('Invalid timestamp')
+    if not isinstance(timestamp, str):
+        timestamp = datetime.fromtimestamp(ts, timezone.utc).isoformat()
+    days, time_from, time_to = data.get('days') or '', data.get('time_from') or '', data.get('time_to') or ''
+    return (data['type'], lat, lon, speed, timestamp, days, time_from, time_to,
+            *compile_schedule(days, time_from, time_to), ts)
+
+# Validate a partial location merged over current and return the columns to set: the supplied
+# fields plus the compiled schedule and epoch columns derived from them
+def patch_columns(current, data):
+    if not isinstance(data, dict) or not set(data) - {'id'}:
+        raise ValueError('Patch must be an object with at least one field')
+    unknown = set(data) - set(LOCATION_FIELDS) - {'id'}
+    if unknown:
+        raise ValueError('Unknown field: %s' % ', '.join(sorted(unknown)))
+    values = dict(zip(ROW_COLUMNS, location_row({**current, **data})))
+    columns = [f for f in LOCATION_FIELDS if f in data]
+    if set(SCHEDULE_FIELDS) & set(data):
+        columns += ['day_mask', 'minute_from', 'minute_to']
+    if 'timestamp' in data:
+        columns.append('ts')
+    return {c: values[c] for c in columns}
+
+# Location row as returned by the API
+def location_dict(r):
+    return {'id': r[0], 'type': r[1], 'lat': r[2], 'lon': r[3], 'speed': r[4], 'timestamp': r[5], 'days': r[6], 'time_from': r[7], 'time_to': r[8],
+            'report_count': r[9]}
+
+# Location row as a GeoJSON point feature
+def location_feature(r):
+    return {'type': 'Feature', 'id': r[0],
+            'geometry': {'type': 'Point', 'coordinates': [r[3], r[2]]},
+            'properties': {'type': r[1], 'speed': r[4], 'timestamp': r[5], 'days': r[6], 'time_from': r[7], 'time_to': r[8],
+                           'report_count': r[9]}}
+
+# Encode location rows from a cursor as a GeoJSON FeatureCollection, one chunk at a time
+def iter_geojson(cursor, chunk_rows):
+    yield '{"type":"FeatureCollection","features":['
+    sep = ''
+    while rows := cursor.fetchmany(chunk_rows):
+        yield sep + json.dumps([location_feature(r) for r in rows], separators=(',', ':'))[1:-1]
+        sep = ','
+    yield ']}'
+
+# Encode location rows from a cursor as CSV with a header row, one chunk at a time
+def iter_csv(cursor, chunk_rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(LOCATION_COLUMNS.split(', '))
+    while True:
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        writer.writerows(rows)
+
+# Export formats: encoder and mimetype
+EXPORT_FORMATS = {'geojson': (iter_geojson, 'application/geo+json'), 'csv': (iter_csv, 'text/csv')}
+
+# Encode location rows from a cursor as a JSON array, one chunk at a time
+def iter_rows_json(cursor, chunk_rows):
+    yield '['
+    sep = ''
+    while rows := cursor.fetchmany(chunk_rows):
+        yield sep + json.dumps([location_dict(r) for r in rows], separators=(',', ':'))[1:-1]
+        sep = ','
+    yield ']'
+
+# Encode location rows from a cursor as blocks of parallel column arrays, one block per chunk.
+# The type column holds indexes into dictionaries.type, which is emitted last.
+def iter_columnar_json(cursor, chunk_rows):
+    types = {}
+    yield '{"blocks":['
+    sep = ''
+    while rows := cursor.fetchmany(chunk_rows):
+        ids, type_, lat, lon, speed, timestamp, days, time_from, time_to, report_count = zip(*rows)
+        block = {'id': ids, 'type': [types.setdefault(t, len(types)) for t in type_], 'lat': lat, 'lon': lon,
+                 'speed': speed, 'timestamp': timestamp, 'days': days, 'time_from': time_from, 'time_to': time_to,
+                 'report_count': report_count}
+        yield sep + json.dumps(block, separators=(',', ':'))
+        sep = ','
+    yield '],"dictionaries":{"type":%s}}' % json.dumps(list(types))
+
+# Current row for an id as a location dict, or None
+def fetch_location(conn, location_id):
+    row = conn.execute('SELECT ' + LOCATION_COLUMNS + ' FROM locations WHERE id=?', (location_id,)).fetchone()
+    return location_dict(row) if row else None
+
+# Insert validated rows and return their new ids; the caller owns the transaction.
+# AUTOINCREMENT ids within one write transaction are consecutive.
+def insert_locations(conn, rows):
+    if not rows:
+        return range(0)
+    conn.executemany(INSERT_LOCATION_SQL, rows)
+    last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'locations'").fetchone()[0]
+    return range(last - len(rows) + 1, last + 1)
+
+# Merge mode: a new report within DEDUP_RADIUS_M metres and DEDUP_WINDOW seconds of an incident
+# of the same DEDUP_TYPES type is folded into it instead of becoming a row of its own
+def merge_mode():
+    return app.config['DEDUP_RADIUS_M'] > 0
+
+# Nearest incident a row merges into as (id, lat, lon, speed, ts, report_count), or None.
+# Candidates come from the R*Tree box around the point, so the cost does not grow with the table.
+def find_incident(conn, row):
+    type_, lat, lon, ts = row[0], row[1], row[2], row[11]
+    if type_ not in app.config['DEDUP_TYPES']:
+        return None
+    radius, window = app.config['DEDUP_RADIUS_M'], app.config['DEDUP_WINDOW']
+    dlat = math.degrees(radius / EARTH_RADIUS_M) + RTREE_EPS_DEG
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6) + RTREE_EPS_DEG
+    candidates = conn.execute('''SELECT l.id, l.lat, l.lon, l.speed, l.ts, l.report_count
+                                 FROM locations_rtree r JOIN locations l ON l.id = r.id
+                                 WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?
+                                 AND l.type = ? AND l.ts BETWEEN ? AND ?''',
+                              (lat - dlat, lat + dlat, lon - dlon, lon + dlon, type_, ts - window, ts + window)).fetchall()
+    if not candidates:
+        return None
+    dist = haversine_m(lat, lon, np.array([c[1] for c in candidates]), np.array([c[2] for c in candidates]))
+    nearest = int(np.argmin(dist))
+    return candidates[nearest] if dist[nearest] <= radius else None
+
+# Insert rows in merge mode, one at a time so duplicates within the batch merge too. A merged
+# report moves the incident to the mean position and speed of its reports and keeps the latest
+# timestamp. Rows as they were before this write are collected into before and their new state
+# into after, both by id, so a row touched twice is reported once. Returns the number merged.
+def merge_locations(conn, rows, before, after):
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    merged = 0
+    for row in rows:
+        incident = find_incident(conn, row)
+        if incident is None:
+            location_id = conn.execute(INSERT_LOCATION_SQL, row).lastrowid
+            after[location_id] = {'id': location_id, **dict(zip(LOCATION_FIELDS, row)), 'report_count': 1}
+            continue
+        location_id, lat, lon, speed, ts, n = incident
+        if location_id not in after:
+            before[location_id] = after[location_id] = fetch_location(conn, location_id)
+        current = after[location_id]
+        lat, lon = (lat * n + row[1]) / (n + 1), (lon * n + row[2]) / (n + 1)
+        speed = row[3] if speed is None else (speed * n + row[3]) / (n + 1)
+        timestamp, ts = (row[4], row[11]) if row[11] > ts else (current['timestamp'], ts)
+        conn.execute('UPDATE locations SET lat=?, lon=?, speed=?, timestamp=?, ts=?, report_count=report_count+1 '
+                     'WHERE id=?', (lat, lon, speed, timestamp, ts, location_id))
+        after[location_id] = dict(current, lat=lat, lon=lon, speed=speed, timestamp=timestamp,
+                                  report_count=current['report_count'] + 1)
+        merged += 1
+    return merged
+
+# Write validated rows, merging near-duplicates in merge mode; the caller owns the transaction.
+# With notify the changed rows are collected into before/after as for merge_locations().
+# Returns the number of rows merged.
+def write_locations(conn, rows, before, after, notify=True):
+    if merge_mode():
+        return merge_locations(conn, rows, before if notify else {}, after if notify else {})
+    ids = insert_locations(conn, rows)
+    if notify:
+        after.update((i, {'id': i, **dict(zip(LOCATION_FIELDS, row)), 'report_count': 1}) for i, row in zip(ids, rows))
+    return 0
+
+# Refresh derived caches after a committed write; removed/added are location dicts and
+# version is the change-log version read inside the write transaction, when known
+def locations_changed(removed=(), added=(), version=None):
+    location_store.apply(removed, added, version)
+    update_heatmaps(removed, added, version)
+    bump_write_version()
+    invalidate_tiles([*removed, *added])
+    publish_changes(removed, added)
+
+# Drop all derived caches after a write too large to describe row by row
+def locations_reset():
+    location_store.clear()
+    with _heatmap_lock:
+        _heatmaps.clear()
+    bump_write_version()
+    shutil.rmtree(app.config['TILE_CACHE_DIR'], ignore_errors=True)
+    publish_events([{'old': None, 'new': None, 'data': json.dumps({'op': 'reset'})}])
+
+# In-process read cache. The version counter only sees writes made by this process,
+# so multi-process deployments must route writes to one worker or disable the cache.
+_boot_id = os.urandom(4).hex()
+_write_version = 0
+_cache_lock = threading.Lock()
+_response_cache = OrderedDict()
+_response_cache_bytes = 0
+cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0}
+
+# Invalidate every cached read and every ETag handed out so far
+def bump_write_version():
+    global _write_version, _response_cache_bytes
+    with _cache_lock:
+        _write_version += 1
+        _response_cache.clear()
+        _response_cache_bytes = 0
+
+# Remember a serialized response, evicting least recently used entries beyond the byte budget
+def cache_store(key, entry):
+    global _response_cache_bytes
+    size = len(entry['body']) + len(entry['gzip'] or b'')
+    with _cache_lock:
+        if key[0] != _write_version or size > app.config['RESPONSE_CACHE_BYTES']:
+            return
+        old = _response_cache.pop(key, None)
+        if old:
+            _response_cache_bytes -= old['size']
+        _response_cache[key] = dict(entry, size=size)
+        _response_cache_bytes += size
+        while _response_cache_bytes > app.config['RESPONSE_CACHE_BYTES']:
+            _, evicted = _response_cache.popitem(last=False)
+            _response_cache_bytes -= evicted['size']
+            cache_stats['evictions'] += 1
+
+# Serve a read endpoint from the in-process cache with strong ETags and precompressed bodies.
+# Streamed responses bypass the cache.
+def cached_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config['RESPONSE_CACHE_BYTES'] or request.args.get('stream') in ('1', 'true'):
+            return view(*args, **kwargs)
+        version = _write_version
+        key = (version, request.path, tuple(sorted(request.args.items(multi=True))), request.headers.get('Accept', ''))
+        etag = '%s.%d.%s' % (_boot_id, version, hashlib.sha1(repr(key[1:]).encode()).hexdigest()[:16])
+        use_gzip = request.accept_encodings['gzip'] > 0
+        if request.if_none_match.contains(etag) or request.if_none_match.contains(etag + '-gz'):
+            cache_stats['not_modified'] += 1
+            response = app.response_class(status=304)
+            response.set_etag(etag + '-gz' if use_gzip else etag)
+            return response
+        with _cache_lock:
+            entry = _response_cache.get(key)
+            if entry:
+                _response_cache.move_to_end(key)
+                cache_stats['hits'] += 1
+        if entry is None:
+            cache_stats['misses'] += 1
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            entry = {'body': body, 'mimetype': response.mimetype,
+                     'gzip': gzip.compress(body, 6) if len(body) >= app.config['RESPONSE_GZIP_MIN_BYTES'] else None,
+                     'headers': [(k, v) for k, v in response.headers.items() if k.startswith('X-') or k == 'Vary']}
+            cache_store(key, entry)
+        response = app.response_class(entry['body'], mimetype=entry['mimetype'], headers=entry['headers'])
+        if use_gzip and entry['gzip']:
+            response.set_data(entry['gzip'])
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += '-gz'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+# On-disk cache path of a tile
+def tile_path(z, x, y):
+    return os.path.join(app.config['TILE_CACHE_DIR'], str(z), str(x), '%d.geojson' % y)
+
+# Remove the cached tiles covering each location at every zoom level
+def invalidate_tiles(locations):
+    tiles = {(z, *lonlat_to_tile(loc['lon'], loc['lat'], z))
+             for loc in locations
+             for z in range(app.config['TILE_MIN_ZOOM'], app.config['TILE_MAX_ZOOM'] + 1)}
+    for tile in tiles:
+        try:
+            os.remove(tile_path(*tile))
+        except FileNotFoundError:
+            pass
+
+# GeoJSON FeatureCollection of the locations inside a tile
+def render_tile(conn, z, x, y):
+    west, north = tile_to_lonlat(x, y, z)
+    east, south = tile_to_lonlat(x + 1, y + 1, z)
+    rows = conn.execute(LOCATION_SELECT + '''
+                           FROM locations_rtree r JOIN locations l ON l.id = r.id
+                           WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?
+                           AND l.lat > ? AND l.lat <= ? AND l.lon >= ? AND l.lon < ?''',
+                        (south - RTREE_EPS_DEG, north + RTREE_EPS_DEG, west - RTREE_EPS_DEG, east + RTREE_EPS_DEG,
+                         south, north, west, east))
+    features = [location_feature(r) for r in rows]
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':')).encode()
+
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+MAX_JSON_ELEMENT = 1024 * 1024
+
+# Yield the elements of a JSON array read incrementally from a byte stream. With key the body
+# is an object and the array is its member of that name, as "features" in GeoJSON; members
+# before it are skipped and nothing after the array is read.
+def iter_json_array(stream, chunk_size=64 * 1024, key=None):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = '', 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        if eof:
+            raise ValueError('Unexpected end of JSON array')
+        if len(buf) - pos > MAX_JSON_ELEMENT:
+            raise ValueError('JSON array element too large')
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + text.decode(chunk, final=eof), 0
+
+    # (value, end) of the JSON value at pos, or None when it may have been cut off mid-token
+    # because it is not followed by one of the delimiters
+    def decode(delimiters):
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            return None
+        if not eof and (end == len(buf) or buf[end] not in delimiters):
+            return None
+        return value, end
+
+    expect = '{' if key else '['
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            fill()
+            continue
+        ch = buf[pos]
+        if expect == '{':
+            if ch != '{':
+                raise ValueError('Body must be a JSON object')
+            pos, expect = pos + 1, 'name'
+        elif expect in ('name', 'member'):
+            if expect == 'name' and ch != '"':
+                raise ValueError('No "%s" array in JSON object' % key)
+            decoded = decode(' \t\r\n:' if expect == 'name' else ' \t\r\n,}')
+            if decoded is None:
+                fill()
+                continue
+            if expect == 'name':
+                (name, pos), expect = decoded, ':'
+            else:
+                pos, expect = decoded[1], 'next'
+        elif expect == ':':
+            if ch != ':':
+                raise ValueError('Expected : in JSON object')
+            pos, expect = pos + 1, '[' if name == key else 'member'
+        elif expect == 'next':
+            if ch != ',':
+                raise ValueError('No "%s" array in JSON object' % key)
+            pos, expect = pos + 1, 'name'
+        elif expect == '[':
+            if ch != '[':
+                raise ValueError('Body must be a JSON array')
+            pos, expect = pos + 1, 'first'
+        elif ch == ']' and expect in ('first', ','):
+            return
+        elif expect == ',':
+            if ch != ',':
+                raise ValueError('Expected , or ] in JSON array')
+            pos, expect = pos + 1, 'value'
+        else:
+            decoded = decode(' \t\r\n,]')
+            if decoded is None:
+                fill()
+                continue
+            value, pos = decoded
+            yield value
+            expect = ','
+
+# Yield the non-blank lines of a byte stream, decoded as JSON values (or the error). A line
+# longer than MAX_JSON_ELEMENT yields one error and is skipped up to the next newline.
+def iter_ndjson(stream, chunk_size=64 * 1024):
+    pending, skipping = b'', False
+    while True:
+        chunk = stream.read(chunk_size)
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop() if chunk else b''
+        if skipping:
+            # The first line ends the one being skipped; without a newline it continues
+            if lines:
+                lines.pop(0)
+                skipping = False
+            else:
+                pending = b''
+        for line in lines:
+            if len(line) > MAX_JSON_ELEMENT:
+                yield ValueError('NDJSON line too large')
+            elif line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield e
+        if len(pending) > MAX_JSON_ELEMENT:
+            yield ValueError('NDJSON line too large')
+            pending, skipping = b'', True
+        if not chunk:
+            return
+
+# Locations parsed incrementally from a GeoJSON FeatureCollection of points or a CSV file with
+# a header row, as dicts for location_row() or the error for a bad feature. Ids are ignored.
+def iter_import(stream, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+        return
+    for feature in iter_json_array(stream, key='features'):
+        try:
+            lon, lat = feature['geometry']['coordinates'][:2]
+            yield dict(feature.get('properties') or {}, lat=lat, lon=lon)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            yield ValueError('Invalid GeoJSON point feature')
+
+# Index-maintaining triggers and secondary indexes on locations, as (kind, name, sql); the
+# change log triggers stay so the location store and /get_locations?since= keep working
+def deferrable_indexes(conn):
+    return conn.execute('''SELECT type, name, sql FROM sqlite_master
+                           WHERE tbl_name = 'locations' AND sql IS NOT NULL
+                           AND (type = 'index' OR type = 'trigger' AND name NOT LIKE 'location\\_changes\\_%' ESCAPE '\\')''').fetchall()
+
+# Recreate deferred indexes and triggers and rebuild the tables the triggers maintain
+def restore_indexes(conn, deferred):
+    conn.execute('BEGIN IMMEDIATE')
+    for _, _, sql in deferred:
+        conn.execute(sql)
+    conn.execute('DELETE FROM locations_rtree')
+    conn.execute('INSERT INTO locations_rtree SELECT id, lat, lat, lon, lon FROM locations')
+    rebuild_clusters(conn, conn.execute('SELECT zoom, cell FROM cluster_levels ORDER BY zoom').fetchall())
+    rebuild_speed_stats(conn)
+    conn.commit()
+
+# Load parsed locations in transactions of chunk_rows rows and return counts, the first
+# BULK_MAX_ERRORS row errors and the load rate. A malformed file stops the load after the last
+# committed chunk. With defer_indexes the secondary indexes and index-maintaining triggers are
+# dropped for the load and rebuilt once at the end; other writers' rows are reindexed then too.
+def import_locations(conn, items, chunk_rows, defer_indexes=False):
+    start = time.perf_counter()
+    max_errors, notify_limit = app.config['BULK_MAX_ERRORS'], app.config['BULK_NOTIFY_ROWS']
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+    deferred = deferrable_indexes(conn) if defer_indexes else []
+    if deferred:
+        conn.execute('BEGIN IMMEDIATE')
+        for kind, name, _ in deferred:
+            conn.execute('DROP %s %s' % (kind.upper(), name))
+        conn.commit()
+
+    def load(chunk):
+        ids = insert_locations(conn, chunk)
+        version = data_version(conn)
+        conn.commit()
+        if result['imported'] + len(chunk) <= notify_limit and not deferred:
+            locations_changed(added=[{'id': i, **dict(zip(LOCATION_FIELDS, row)), 'report_count': 1} for i, row in zip(ids, chunk)],
+                              version=version)
+        result['imported'] += len(chunk)
+
+    chunk = []
+    try:
+        for index, item in enumerate(items):
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                chunk.append(location_row(item))
+            except ValueError as e:
+                result['failed'] += 1
+                if len(result['errors']) < max_errors:
+                    result['errors'].append({'index': index, 'error': str(e)})
+                continue
+            if len(chunk) >= chunk_rows:
+                load(chunk)
+                chunk = []
+        load(chunk)
+    except (ValueError, csv.Error) as e:
+        conn.rollback()
+        result['message'] = str(e)
+    finally:
+        if deferred:
+            restore_indexes(conn, deferred)
+    if deferred or result['imported'] > notify_limit:
+        locations_reset()
+    result['seconds'] = time.perf_counter() - start
+    result['rows_per_second'] = result['imported'] / result['seconds'] if result['seconds'] else 0.0
+    return result
+
+# Hazard arrays with a uniform lat/lon grid index, rebuilt when the change-log version moves.
+# With LOCATION_STORE they are taken from the location store, which catches up through
+# location_changes, so writes from other processes are seen and no table read is needed.
+_hazards = None
+_hazards_lock = threading.Lock()
+
+# Current hazard snapshot; hazards are sorted by grid cell key for range lookups
+def hazard_index():
+    global _hazards
+    conn = get_db()
+    if app.config['LOCATION_STORE']:
+        location_store.ensure(conn)
+        version = location_store.version
+    else:
+        version = data_version(conn)
+    with _hazards_lock:
+        if _hazards is not None and _hazards['version'] == version:
+            return _hazards
+        if app.config['LOCATION_STORE']:
+            with location_store.lock:
+                version = location_store.version
+                positions = np.flatnonzero(location_store.alive[:location_store.size])
+                cols = {name: location_store.columns[name][positions]
+                        for name in ('id', 'type', 'lat', 'lon', 'speed', 'day_mask', 'minute_from', 'minute_to')}
+                names = list(location_store.values['type'])
+            cols['type'] = np.array([LOCATION_TYPES.index(t) if t in LOCATION_TYPES else 0 for t in names],
+                                    dtype=np.uint8)[cols['type']]
+        else:
+            # One read transaction so the version matches the rows
+            conn.execute('BEGIN')
+            try:
+                version = data_version(conn)
+                rows = conn.execute('SELECT id, type, lat, lon, speed, day_mask, minute_from, minute_to FROM locations').fetchall()
+            finally:
+                conn.commit()
+            ids, types, lat, lon, speed, day_mask, minute_from, minute_to = zip(*rows) if rows else ([],) * 8
+            cols = {'id': np.array(ids, dtype=np.int64), 'lat': np.array(lat, dtype=np.float64),
+                    'lon': np.array(lon, dtype=np.float64), 'speed': np.array(speed, dtype=np.float64),
+                    'type': np.array([LOCATION_TYPES.index(t) if t in LOCATION_TYPES else 0 for t in types], dtype=np.uint8),
+                    'day_mask': np.array([m or 0 for m in day_mask], dtype=np.int64),
+                    'minute_from': np.array([m or 0 for m in minute_from], dtype=np.int64),
+                    'minute_to': np.array([m if m is not None else 1439 for m in minute_to], dtype=np.int64)}
+        lat, lon = cols['lat'], cols['lon']
+        # Longitude cells are sized at the highest latitude so they are never narrower than the grid size
+        cell_lat = app.config['HAZARD_GRID_M'] / (math.radians(1) * EARTH_RADIUS_M)
+        cell_lon = cell_lat / math.cos(math.radians(np.abs(lat).max() if len(lat) else 0))
+        keys = grid_keys(lat, lon, cell_lat, cell_lon)
+        order = np.argsort(keys)
+        _hazards = {'version': version, 'cell_lat': cell_lat, 'cell_lon': cell_lon, 'keys': keys[order],
+                    'id': cols['id'][order], 'lat': lat[order], 'lon': lon[order], 'type': cols['type'][order],
+                    'speed': cols['speed'][order], 'day_mask': cols['day_mask'][order].astype(np.int64),
+                    'minute_from': cols['minute_from'][order].astype(np.int64),
+                    'minute_to': cols['minute_to'][order].astype(np.int64)}
+        return _hazards
+
+# Packed int64 grid cell keys for coordinate arrays
+def grid_keys(lat, lon, cell_lat, cell_lon, dy=0, dx=0):
+    cy = np.floor(lat / cell_lat).astype(np.int64) + dy
+    cx = np.floor(lon / cell_lon).astype(np.int64) + dx
+    return (cx << 32) + cy
+
+# Great-circle distance in metres between coordinate arrays
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+# All (position, hazard) index pairs within radius, found through the grid and filtered by exact distance
+def hazards_near(hazards, lat, lon, radius):
+    rings = math.ceil(radius / app.config['HAZARD_GRID_M'])
+    pos_parts, haz_parts = [], []
+    for dy in range(-rings, rings + 1):
+        for dx in range(-rings, rings + 1):
+            keys = grid_keys(lat, lon, hazards['cell_lat'], hazards['cell_lon'], dy, dx)
+            lo = np.searchsorted(hazards['keys'], keys, 'left')
+            counts = np.searchsorted(hazards['keys'], keys, 'right') - lo
+            total = counts.sum()
+            if not total:
+                continue
+            # Expand each position's [lo, hi) hazard range into explicit pairs
+            pos = np.repeat(np.arange(len(lat)), counts)
+            haz = np.repeat(lo, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pos_parts.append(pos)
+            haz_parts.append(haz)
+    if not pos_parts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    pos, haz = np.concatenate(pos_parts), np.concatenate(haz_parts)
+    dist = haversine_m(lat[pos], lon[pos], hazards['lat'][haz], hazards['lon'][haz])
+    near = dist <= radius
+    return pos[near], haz[near], dist[near]
+
+# Boolean mask of hazards whose compiled schedule is active at (weekday, minute)
+def hazards_active(hazards, haz, day, minute):
+    mask, start, end = hazards['day_mask'][haz], hazards['minute_from'][haz], hazards['minute_to'][haz]
+    wraps = start > end
+    return ((((mask >> day) & 1) == 1) & (((start <= minute) & (end >= minute)) | (wraps & (start <= minute)))
+            | (wraps & (((mask >> ((day - 1) % 7)) & 1) == 1) & (end >= minute)))
+
+# Base-resolution heatmap grids per type over TANJORE_BOUNDS: point counts and speed sums,
+# with the change-log version they were read at. Built on first use and then kept current by
+# locations_changed(), which skips writes the grids already include.
+_heatmaps = {}
+_heatmap_lock = threading.Lock()
+
+# Base grid geometry as (south, west, cell size in degrees, rows, cols); rows and cols
+# are multiples of the coarsest zoom factor so every zoom level divides them evenly
+def heatmap_grid():
+    (south, west), (north, east) = TANJORE_BOUNDS
+    cell = app.config['HEATMAP_CELL_PX'] * 360.0 / (256 * 2 ** app.config['HEATMAP_MAX_ZOOM'])
+    factor = 2 ** (app.config['HEATMAP_MAX_ZOOM'] - app.config['HEATMAP_MIN_ZOOM'])
+    rows = math.ceil((north - south) / cell / factor) * factor
+    cols = math.ceil((east - west) / cell / factor) * factor
+    return south, west, cell, rows, cols
+
+# Flat base-grid cell index for coordinate arrays, and the mask of points inside the grid
+def heatmap_cells(lat, lon):
+    south, west, cell, rows, cols = heatmap_grid()
+    iy = np.floor((np.asarray(lat, dtype=np.float64) - south) / cell).astype(np.int64)
+    ix = np.floor((np.asarray(lon, dtype=np.float64) - west) / cell).astype(np.int64)
+    inside = (iy >= 0) & (iy < rows) & (ix >= 0) & (ix < cols)
+    return iy * cols + ix, inside
+
+# Count and speed-sum grids for one type, histogrammed from the table on first use
+def heatmap_for(type_):
+    with _heatmap_lock:
+        if type_ not in _heatmaps:
+            # One read transaction so the version matches the rows
+            conn = get_db()
+            conn.execute('BEGIN')
+            try:
+                version = data_version(conn)
+                rows = conn.execute('SELECT lat, lon, speed FROM locations WHERE type=?', (type_,)).fetchall()
+            finally:
+                conn.commit()
+            lat, lon, speed = (np.array(col, dtype=np.float64) for col in zip(*rows)) if rows else (np.empty(0),) * 3
+            flat, inside = heatmap_cells(lat, lon)
+            _, _, _, nrows, ncols = heatmap_grid()
+            counts = np.bincount(flat[inside], minlength=nrows * ncols).astype(np.int32)
+            # bincount of empty weights is int64; speed deltas must not be truncated
+            speeds = np.bincount(flat[inside], weights=speed[inside], minlength=nrows * ncols).astype(np.float64)
+            _heatmaps[type_] = (counts.reshape(nrows, ncols), speeds.reshape(nrows, ncols), version)
+        return _heatmaps[type_][:2]
+
+# Apply single-row changes to the heatmap grids that have been built; version is the
+# change-log version after the write, and grids read at or after it already include it
+def update_heatmaps(removed, added, version=None):
+    with _heatmap_lock:
+        if not _heatmaps:
+            return
+        for rows, sign in ((removed, -1), (added, 1)):
+            for loc in rows:
+                if loc['type'] not in _heatmaps:
+                    continue
+                counts, speeds, built = _heatmaps[loc['type']]
+                if version is not None and version <= built:
+                    continue
+                flat, inside = heatmap_cells([loc['lat']], [loc['lon']])
+                if inside[0]:
+                    counts.flat[flat[0]] += sign
+                    speeds.flat[flat[0]] += sign * loc['speed']
+
+# In-process columnar mirror of the locations table, so reads can filter and aggregate with
+# NumPy instead of SQL. Rows are kept in id order with an alive mask (deletes leave holes
+# until compaction). Text with few distinct values is dictionary-encoded into uint16 codes and
+# the client timestamp is stored as fixed-width bytes. That is ~89 bytes per row, plus up to
+# 2x growth slack, against ~700 bytes for the row dict a SQLite read builds per location.
+# SQLite stays the source of truth: version is the change-log version the arrays reflect.
+# Writes made here are applied write-through; reads catch up through location_changes
+# whenever the database is ahead, which also covers writes from other processes.
+STORE_COLUMNS = (('id', np.int64), ('type', np.uint16), ('lat', np.float64), ('lon', np.float64),
+                 ('speed', np.float64), ('timestamp', 'S32'), ('days', np.uint16), ('time_from', np.uint16),
+                 ('time_to', np.uint16), ('day_mask', np.uint8), ('minute_from', np.int16),
+                 ('minute_to', np.int16), ('ts', np.int64), ('report_count', np.int32))
+STORE_ENCODED = ('type', 'days', 'time_from', 'time_to')
+STORE_SELECT = ('SELECT l.id, l.type, l.lat, l.lon, l.speed, l.timestamp, l.days, l.time_from, l.time_to, '
+                'l.day_mask, l.minute_from, l.minute_to, l.ts, l.report_count')
+NULL_TS = np.iinfo(np.int64).min
+
+class LocationStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    # Forget everything; the next read reloads from the database
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.size = 0
+            self.dead = 0
+            self.columns = {name: np.empty(0, dtype) for name, dtype in STORE_COLUMNS}
+            self.alive = np.empty(0, np.bool_)
+            self.values = {name: [] for name in STORE_ENCODED}
+            self.codes = {name: {} for name in STORE_ENCODED}
+
+    def nbytes(self):
+        return sum(col.nbytes for col in self.columns.values()) + self.alive.nbytes
+
+    # Grow every column to hold at least capacity rows, doubling to amortize appends
+    def reserve(self, capacity):
+        if capacity <= len(self.alive):
+            return
+        capacity = max(capacity, 2 * len(self.alive), 1024)
+        for name, col in self.columns.items():
+            grown = np.empty(capacity, col.dtype)
+            grown[:self.size] = col[:self.size]
+            self.columns[name] = grown
+        alive = np.zeros(capacity, np.bool_)
+        alive[:self.size] = self.alive[:self.size]
+        self.alive = alive
+
+    def encode(self, name, value):
+        code = self.codes[name].get(value)
+        if code is None:
+            code = self.codes[name][value] = len(self.values[name])
+            self.values[name].append(value)
+        return code
+
+    # Write records (tuples in STORE_SELECT order) into rows at the given positions
+    def assign(self, positions, records):
+        cols = list(zip(*records))
+        for (name, _), values in zip(STORE_COLUMNS, cols):
+            if name in STORE_ENCODED:
+                values = [self.encode(name, v) for v in values]
+            elif name == 'timestamp':
+                values = np.array([(v or '').encode() for v in values], dtype=np.bytes_)
+                if values.dtype.itemsize > self.columns[name].dtype.itemsize:
+                    self.columns[name] = self.columns[name].astype(values.dtype)
+            elif name == 'ts':
+                values = [NULL_TS if v is None else v for v in values]
+            elif name in ('lat', 'lon', 'speed'):
+                values = np.array(values, dtype=np.float64)
+            self.columns[name][positions] = values
+        self.alive[positions] = True
+
+    # Insert or replace records by id, then restore id order if needed
+    def upsert(self, records):
+        if not records:
+            return
+        ids = np.array([r[0] for r in records], dtype=np.int64)
+        pos, found = self.find(ids)
+        if found.any():
+            existing = pos[found]
+            self.dead -= int(np.count_nonzero(~self.alive[existing]))
+            self.assign(existing, [r for r, f in zip(records, found) if f])
+        new = [r for r, f in zip(records, found) if not f]
+        if new:
+            self.reserve(self.size + len(new))
+            start = self.size
+            self.size += len(new)
+            self.assign(np.arange(start, self.size), new)
+            if start and self.columns['id'][start] < self.columns['id'][start - 1] or \
+                    np.any(np.diff(self.columns['id'][start:self.size]) < 0):
+                order = np.argsort(self.columns['id'][:self.size], kind='stable')
+                for col in self.columns.values():
+                    col[:self.size] = col[:self.size][order]
+                self.alive[:self.size] = self.alive[:self.size][order]
+
+    # Positions of ids in the id column, and which of them are present
+    def find(self, ids):
+        column = self.columns['id'][:self.size]
+        pos = np.searchsorted(column, ids)
+        found = pos < self.size
+        found[found] = column[pos[found]] == ids[found]
+        return pos, found
+
+    def delete(self, ids):
+        if not ids:
+            return
+        pos, found = self.find(np.fromiter(ids, np.int64, len(ids)))
+        pos = pos[found]
+        pos = pos[self.alive[pos]]
+        self.alive[pos] = False
+        self.dead += len(pos)
+        if self.dead > max(1024, self.size // 4):
+            self.compact()
+
+    # Drop deleted rows
+    def compact(self):
+        keep = np.flatnonzero(self.alive[:self.size])
+        for col in self.columns.values():
+            col[:len(keep)] = col[keep]
+        self.alive[:len(keep)] = True
+        self.alive[len(keep):] = False
+        self.size, self.dead = len(keep), 0
+
+    # Rebuild from the database inside one read transaction
+    def load(self, conn):
+        with self.lock:
+            self.clear()
+            chunk_rows = app.config['STREAM_CHUNK_ROWS'] * 10
+            conn.execute('BEGIN')
+            try:
+                version = data_version(conn)
+                cursor = conn.execute(STORE_SELECT + ' FROM locations l ORDER BY l.id')
+                while rows := cursor.fetchmany(chunk_rows):
+                    self.upsert(rows)
+            finally:
+                conn.commit()
+            self.version = version
+
+    # Apply the changes logged after self.version, or reload when the deletes since then
+    # have been pruned from the change log
+    def sync(self, conn):
+        with self.lock:
+            conn.execute('BEGIN')
+            try:
+                pruned = self.version < change_horizon(conn)
+                if not pruned:
+                    version = data_version(conn)
+                    rows = conn.execute(STORE_SELECT + ' FROM location_changes c CROSS JOIN locations l '
+                                        'ON l.id = c.location_id WHERE c.version > ?', (self.version,)).fetchall()
+                    deleted = [r[0] for r in conn.execute('SELECT location_id FROM location_changes '
+                                                          'WHERE version > ? AND deleted = 1', (self.version,))]
+            finally:
+                conn.commit()
+            if pruned:
+                self.load(conn)
+                return
+            self.upsert(rows)
+            self.delete(deleted)
+            self.version = version
+
+    # Bring the store up to the database's version. The version is read under the lock, so a
+    # write applied here meanwhile cannot make the database look behind the store. Behind it
+    # can still be an open transaction's older snapshot, which the store is simply newer than;
+    # only a fresh read that is behind, a database restored or replaced, reloads.
+    def ensure(self, conn):
+        with self.lock:
+            current = data_version(conn)
+            if self.version is None or current < self.version and not conn.in_transaction:
+                self.load(conn)
+            elif current > self.version:
+                self.sync(conn)
+
+    # Rows matching request args as (version, StoreRows); raises ValueError on bad filters
+    def query(self, conn, args, where=None):
+        self.ensure(conn)
+        with self.lock:
+            return self.version, self.rows(self.select(args, where))
+
+    # Compare with a fresh load from the database and adopt it on any difference.
+    # Returns the names of the columns that differed.
+    def verify(self, conn):
+        fresh = LocationStore()
+        with self.lock:
+            for _ in range(3):
+                self.ensure(conn)
+                fresh.load(conn)
+                if fresh.version == self.version:
+                    break
+            mine = np.flatnonzero(self.alive[:self.size])
+            differing = []
+            if fresh.version != self.version or len(mine) != fresh.size:
+                differing.append('rows')
+            else:
+                for name, _ in STORE_COLUMNS:
+                    a, b = self.columns[name][mine], fresh.columns[name][:fresh.size]
+                    if name in STORE_ENCODED:
+                        a = np.array(self.values[name], dtype=object)[a]
+                        b = np.array(fresh.values[name], dtype=object)[b]
+                    if not np.array_equal(a, b, equal_nan=a.dtype.kind == 'f'):
+                        differing.append(name)
+            if differing:
+                self.__dict__.update({k: v for k, v in fresh.__dict__.items() if k != 'lock'})
+            return differing
+
+    # Write-through from locations_changed(). version is the change-log version after the
+    # write; the store only applies a write that directly followed its own version. Anything
+    # else, such as an older write whose callback runs after the store has synced past it, is
+    # left to sync(), which would otherwise never revisit the rows overwritten here.
+    def apply(self, removed, added, version=None):
+        with self.lock:
+            changed = len({loc['id'] for loc in added} | {loc['id'] for loc in removed})
+            if self.version is None or version is None or self.version != version - changed:
+                return
+            records = []
+            for loc in added:
+                try:
+                    schedule = compile_schedule(loc['days'], loc['time_from'], loc['time_to'])
+                except ValueError:
+                    schedule = (0, 0, 1439)
+                records.append((loc['id'], *(loc[f] for f in LOCATION_FIELDS), *schedule, epoch_column(loc['timestamp']),
+                                loc['report_count']))
+            self.upsert(records)
+            self.delete({loc['id'] for loc in removed} - {loc['id'] for loc in added})
+            self.version = version
+
+    # Positions of alive rows matching the bbox/type/from/to filters of request args,
+    # and optionally a mask built from the columns
+    def select(self, args, where=None):
+        bbox = parse_bbox(args['bbox'], args.get('zoom', type=int)) if args.get('bbox') else None
+        types = [t for t in args.get('type', '').split(',') if t]
+        ts_from = parse_epoch(args['from']) if args.get('from') else None
+        ts_to = parse_epoch(args['to']) if args.get('to') else None
+        cols, n = self.columns, self.size
+        mask = self.alive[:n].copy()
+        if bbox:
+            west, south, east, north = bbox
+            lat, lon = cols['lat'][:n], cols['lon'][:n]
+            mask &= (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        if types:
+            mask &= np.isin(cols['type'][:n], [self.codes['type'][t] for t in types if t in self.codes['type']])
+        if ts_from is not None:
+            mask &= cols['ts'][:n] >= ts_from
+        if ts_to is not None:
+            mask &= (cols['ts'][:n] <= ts_to) & (cols['ts'][:n] != NULL_TS)
+        if where is not None:
+            mask &= where({name: col[:n] for name, col in cols.items()})
+        return np.flatnonzero(mask)
+
+    # Selected rows as a cursor-like object for iter_rows_json/iter_columnar_json
+    def rows(self, positions):
+        with self.lock:
+            return StoreRows({name: col[positions] for name, col in self.columns.items()},
+                             {name: np.array(values, dtype=object) for name, values in self.values.items()})
+
+# Snapshot of selected store rows with a DB-API style fetchmany()
+class StoreRows:
+    def __init__(self, columns, dictionaries):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.offset = 0
+
+    def fetchmany(self, size):
+        part = slice(self.offset, self.offset + size)
+        self.offset += size
+        out = []
+        for name in LOCATION_COLUMNS.split(', '):
+            col = self.columns[name][part]
+            if name in STORE_ENCODED:
+                out.append(self.dictionaries[name][col].tolist())
+            elif name == 'timestamp':
+                out.append([t.decode() if t else None for t in col.tolist()])
+            elif col.dtype.kind == 'f' and np.isnan(col).any():
+                out.append([None if v != v else v for v in col.tolist()])
+            else:
+                out.append(col.tolist())
+        return list(zip(*out))
+
+    def fetchall(self):
+        return self.fetchmany(len(self.columns['id']) - self.offset)
+
+location_store = LocationStore()
+
+# Write-behind queue for /add_location, drained by one background writer thread
+_write_queue = None
+_writer_thread = None
+_writer_lock = threading.Lock()
+_tickets = itertools.count(1)
+_write_stats_lock = threading.Lock()
+write_stats = {'enqueued': 0, 'rejected': 0, 'committed': 0, 'merged': 0, 'failed': 0, 'batches': 0, 'retries': 0,
+               'committed_ticket': 0, 'last_commit_ms': 0.0, 'max_commit_ms': 0.0, 'total_commit_ms': 0.0}
+# Tickets of acknowledged rows that could not be written, most recent last
+lost_tickets = deque(maxlen=10000)
+
+# Queue a validated row for the background writer and return its ticket; raises queue.Full.
+# A writer that has died is restarted on the same queue, so rows already queued are kept.
+def enqueue_location(row):
+    global _write_queue, _writer_thread
+    with _writer_lock:
+        if _write_queue is None:
+            _write_queue = queue.Queue(app.config['WRITE_QUEUE_SIZE'])
+            atexit.register(flush_writes)
+        if _writer_thread is None or not _writer_thread.is_alive():
+            if _writer_thread is not None:
+                app.logger.error('Write-behind thread died; restarting it')
+            _writer_thread = threading.Thread(target=write_behind, name='write-behind', daemon=True)
+            _writer_thread.start()
+        ticket = next(_tickets)
+    try:
+        _write_queue.put((ticket, row), timeout=app.config['WRITE_ENQUEUE_TIMEOUT'])
+    except queue.Full:
+        with _write_stats_lock:
+            write_stats['rejected'] += 1
+        raise
+    with _write_stats_lock:
+        write_stats['enqueued'] += 1
+    return ticket
+
+# Whether an error is SQLite failing to get a lock, which goes away once the holder commits
+def sqlite_busy(e):
+    return isinstance(e, sqlite3.OperationalError) and \
+        getattr(e, 'sqlite_errorcode', 0) & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+# Write a batch in one transaction as (merged, version, before, after), retrying with backoff
+# for up to WRITE_RETRY_SECONDS while the database is busy or locked. Other errors are raised
+# with nothing written.
+def commit_batch(conn, batch):
+    delay, deadline = 0.05, time.monotonic() + app.config['WRITE_RETRY_SECONDS']
+    while True:
+        before, after = {}, {}
+        try:
+            merged = write_locations(conn, [row for _, row in batch], before, after)
+            version = data_version(conn)
+            conn.commit()
+            return merged, version, before, after
+        except Exception as e:
+            conn.rollback()
+            if not sqlite_busy(e) or time.monotonic() + delay > deadline:
+                raise
+        app.logger.warning('Write-behind batch of %d rows waiting for the write lock', len(batch))
+        with _write_stats_lock:
+            write_stats['retries'] += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+
+# Drain the queue in group commits, each closed by WRITE_BATCH_SIZE rows or WRITE_BATCH_WINDOW_MS
+def write_behind():
+    conn = connect_db()
+    stopping = False
+    while not stopping:
+        item = _write_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.monotonic() + app.config['WRITE_BATCH_WINDOW_MS'] / 1000
+        while len(batch) < app.config['WRITE_BATCH_SIZE']:
+            try:
+                item = _write_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        start = time.perf_counter()
+        try:
+            merged, version, before, after = commit_batch(conn, batch)
+        except Exception:
+            tickets = [ticket for ticket, _ in batch]
+            with _write_stats_lock:
+                write_stats['failed'] += len(batch)
+                lost_tickets.extend(tickets)
+            app.logger.exception('Write-behind batch of %d rows failed; lost tickets %s', len(batch),
+                                 ','.join(map(str, tickets)))
+            continue
+        elapsed = (time.perf_counter() - start) * 1000
+        with _write_stats_lock:
+            write_stats.update(committed=write_stats['committed'] + len(batch), merged=write_stats['merged'] + merged,
+                               batches=write_stats['batches'] + 1,
+                               committed_ticket=batch[-1][0], last_commit_ms=elapsed,
+                               max_commit_ms=max(write_stats['max_commit_ms'], elapsed),
+                               total_commit_ms=write_stats['total_commit_ms'] + elapsed)
+        try:
+            locations_changed(removed=list(before.values()), added=list(after.values()), version=version)
+        except Exception:
+            # The batch is committed; caches that may have missed it are dropped instead
+            app.logger.exception('Updating caches after a write-behind batch failed')
+            locations_reset()
+
+# Commit everything still queued and stop the writer; runs at interpreter exit
+def flush_writes():
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _write_queue.put(None)
+        _writer_thread.join()
+
+# Retention: raw points older than the cutoff are folded into location_rollups and deleted,
+# one short BEGIN IMMEDIATE transaction per batch so live writers get the lock in between
+ROLLUP_UPSERT_SQL = '''INSERT INTO location_rollups (day, type, cy, cx, count, sum_speed, max_speed, sum_lat, sum_lon)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (day, type, cy, cx) DO UPDATE SET
+                       count = count + excluded.count, sum_speed = sum_speed + excluded.sum_speed,
+                       max_speed = MAX(max_speed, excluded.max_speed),
+                       sum_lat = sum_lat + excluded.sum_lat, sum_lon = sum_lon + excluded.sum_lon'''
+_retention_thread = None
+_retention_lock = threading.Lock()
+
+# Roll up and delete every point with ts before cutoff, then prune the change-log tombstones
+# older than the run, so the change log does not keep a row per expired point. Returns the
+# number of points removed.
+def apply_retention(cutoff):
+    cell, batch = app.config['ROLLUP_CELL_DEG'], app.config['RETENTION_BATCH_ROWS']
+    zone = ZoneInfo(app.config['SCHEDULE_TIMEZONE'])
+    conn = connect_db()
+    removed = 0
+    try:
+        horizon = data_version(conn)
+        # Walk each type through locations_type_ts, oldest first
+        for type_, in conn.execute('SELECT DISTINCT type FROM locations').fetchall():
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute('SELECT ' + LOCATION_COLUMNS + ', ts FROM locations WHERE type = ? AND ts < ? '
+                                    'ORDER BY ts LIMIT ?', (type_, cutoff, batch)).fetchall()
+                if not rows:
+                    conn.commit()
+                    break
+                cells = {}
+                for r in rows:
+                    day = datetime.fromtimestamp(r[10], zone).date().isoformat()
+                    key = (day, type_, math.floor(r[2] / cell), math.floor(r[3] / cell))
+                    agg = cells.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+                    # A merged incident counts once per report, at its mean position and speed
+                    speed, n = r[4] or 0.0, r[9]
+                    agg[0] += n
+                    agg[1] += speed * n
+                    agg[2] = max(agg[2], speed)
+                    agg[3] += r[2] * n
+                    agg[4] += r[3] * n
+                conn.executemany(ROLLUP_UPSERT_SQL, [(*key, *agg) for key, agg in cells.items()])
+                conn.executemany('DELETE FROM locations WHERE id = ?', [(r[0],) for r in rows])
+                version = data_version(conn)
+                conn.commit()
+                locations_changed(removed=[location_dict(r) for r in rows], version=version)
+                removed += len(rows)
+                time.sleep(app.config['RETENTION_PAUSE_MS'] / 1000)
+        prune_changes(conn, horizon)
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _connections.discard(conn)
+        conn.close()
+    return removed
+
+# Drop tombstones below horizon in bounded batches. The horizon is raised first, so readers
+# behind it reload instead of missing deletes; the newest change is never below it, so
+# data_version() does not go back.
+def prune_changes(conn, horizon):
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('DELETE FROM location_changes_horizon')
+    conn.execute('INSERT INTO location_changes_horizon (version) VALUES (?)', (horizon,))
+    conn.commit()
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        pruned = conn.execute('''DELETE FROM location_changes WHERE location_id IN (
+                                     SELECT location_id FROM location_changes
+                                     WHERE deleted = 1 AND version < ? LIMIT ?)''',
+                              (horizon, app.config['RETENTION_BATCH_ROWS'])).rowcount
+        conn.commit()
+        if not pruned:
+            return
+        time.sleep(app.config['RETENTION_PAUSE_MS'] / 1000)
+
+# Apply RETENTION_DAYS every RETENTION_INTERVAL seconds
+def retention_loop():
+    while True:
+        cutoff = int(time.time()) - app.config['RETENTION_DAYS'] * 86400
+        try:
+            removed = apply_retention(cutoff)
+            if removed:
+                app.logger.info('Retention rolled up %d points older than %s', removed,
+                                datetime.fromtimestamp(cutoff, timezone.utc).isoformat())
+        except sqlite3.Error:
+            app.logger.exception('Retention run failed')
+        time.sleep(app.config['RETENTION_INTERVAL'])
+
+# Start the retention thread with the first request, so its deletes reach this worker's caches
+@app.before_request
+def start_retention():
+    global _retention_thread
+    if _retention_thread is None and app.config['RETENTION_DAYS']:
+        with _retention_lock:
+            if _retention_thread is None:
+                _retention_thread = threading.Thread(target=retention_loop, name='retention', daemon=True)
+                _retention_thread.start()
+
+# Fan-out hub for /events. Events get consecutive ids and sit in a ring buffer; subscribers
+# wait on one condition, so an idle stream costs a waiter rather than a polling loop. Under
+# an async worker (gunicorn -k gevent) the waits are greenlets, not threads.
+_events = deque()
+_event_ids = itertools.count(1)
+_event_cond = threading.Condition()
+_subscribers = 0
+
+# Append events to the ring buffer and wake every subscriber
+def publish_events(events):
+    with _event_cond:
+        for event in events:
+            event['id'] = next(_event_ids)
+            _events.append(event)
+        while len(_events) > app.config['EVENT_BUFFER_SIZE']:
+            _events.popleft()
+        _event_cond.notify_all()
+
+# Turn a committed write into add/update/delete events, pre-serialized once for all subscribers
+def publish_changes(removed, added):
+    old = {loc['id']: loc for loc in removed}
+    events = []
+    for loc in added:
+        op = 'update' if loc['id'] in old else 'add'
+        events.append({'old': old.pop(loc['id'], None), 'new': loc, 'data': json.dumps(dict(loc, op=op))})
+    for loc in old.values():
+        events.append({'old': loc, 'new': None, 'data': json.dumps({'op': 'delete', 'id': loc['id']})})
+    if events:
+        publish_events(events)
+
+# Whether a location falls inside a subscriber's bbox and type filters
+def subscription_matches(loc, bbox, types):
+    if loc is None or (types and loc['type'] not in types):
+        return False
+    if bbox:
+        west, south, east, north = bbox
+        return south <= loc['lat'] <= north and west <= loc['lon'] <= east
+    return True
+
+# SSE stream of the events after last_id that concern a subscriber's filters
+def event_stream(last_id, bbox, types, heartbeat, reset=False):
+    global _subscribers
+    with _event_cond:
+        _subscribers += 1
+    try:
+        yield 'retry: 3000\n\n'
+        if reset:
+            yield 'id: %d\ndata: %s\n\n' % (last_id, json.dumps({'op': 'reset'}))
+        while True:
+            with _event_cond:
+                if not _events or _events[-1]['id'] <= last_id:
+                    _event_cond.wait(heartbeat)
+                pending = []
+                if _events:
+                    first = _events[0]['id']
+                    if last_id < first - 1:
+                        # Replay window exceeded; the client has to reload
+                        pending = [{'id': _events[-1]['id'], 'old': None, 'new': None, 'data': json.dumps({'op': 'reset'})}]
+                    else:
+                        pending = list(itertools.islice(_events, max(last_id - first + 1, 0), None))
+            if not pending:
+                yield ': ping\n\n'
+                continue
+            chunks = []
+            for event in pending:
+                if event['old'] is None and event['new'] is None:
+                    data = event['data']
+                elif subscription_matches(event['new'], bbox, types):
+                    data = event['data']
+                elif subscription_matches(event['old'], bbox, types):
+                    # Moved or retyped out of this subscription
+                    data = json.dumps({'op': 'delete', 'id': event['old']['id']})
+                else:
+                    continue
+                chunks.append('id: %d\ndata: %s\n\n' % (event['id'], data))
+            last_id = pending[-1]['id']
+            yield ''.join(chunks) or ': ping\n\n'
+    finally:
+        with _event_cond:
+            _subscribers -= 1
+
+# The page template, compiled once
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+_index_page = None
+
+# URLs of the built bundle from the vite manifest, or None when it has not been built
+def asset_urls():
+    for name in ('manifest.json', '.vite/manifest.json'):
+        path = os.path.join(app.config['ASSET_DIR'], name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                entry = json.load(f)['assets/main.js']
+            return {'js': '/assets/' + entry['file'], 'css': ['/assets/' + css for css in entry.get('css', [])]}
+    return None
+
+# The page has no per-request content, so it is rendered and gzipped once per process
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    global _index_page
+    if _index_page is None:
+        body = INDEX_TEMPLATE.render(assets=asset_urls()).encode()
+        _index_page = {'body': body, 'gzip': gzip.compress(body, 9), 'etag': hashlib.sha1(body).hexdigest()[:16]}
+    use_gzip = request.accept_encodings['gzip'] > 0
+    response = app.response_class(_index_page['gzip'] if use_gzip else _index_page['body'], mimetype='text/html')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(_index_page['etag'] + ('-gz' if use_gzip else ''))
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Fingerprinted build output, served from the .br/.gz sibling the client accepts
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    path = safe_join(app.config['ASSET_DIR'], filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] > 0 and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, max_age=app.config['ASSET_MAX_AGE'])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=app.config['ASSET_MAX_AGE'])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/add_location', methods=['POST'])
 def add_location():
-    data = request.get_json()
-    conn = sqlite3.connect('locations.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO locations (type, lat, lon, speed, timestamp, days, time_from, time_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-              (data['type'], data['lat'], data['lon'], float(data['speed']), data['timestamp'], data['days'], data['time_from'], data['time_to']))
+    try:
+        row = location_row(request.get_json())
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if app.config['ASYNC_WRITES']:
+        try:
+            ticket = enqueue_location(row)
+        except queue.Full:
+            return jsonify({'status': 'error', 'message': 'Write queue full'}), 503, {'Retry-After': '1'}
+        return jsonify({'status': 'queued', 'ticket': ticket}), 202
+    conn = get_db()
+    before, after = {}, {}
+    merged = write_locations(conn, [row], before, after)
+    version = data_version(conn)
+    if merged:
+        location_id, = after
+        report_count, = conn.execute('SELECT report_count FROM locations WHERE id=?', (location_id,)).fetchone()
     conn.commit()
-    conn.close()
+    locations_changed(removed=list(before.values()), added=list(after.values()), version=version)
+    if merged:
+        return jsonify({'status': 'success', 'merged_into': location_id, 'report_count': report_count})
     return jsonify({'status': 'success'})
 
+@app.route('/add_locations', methods=['POST'])
+def add_locations():
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        items = iter_ndjson(request.stream)
+    else:
+        items = iter_json_array(request.stream)
+    chunk_size, max_errors = app.config['BULK_CHUNK_SIZE'], app.config['BULK_MAX_ERRORS']
+    notify_limit = app.config['BULK_NOTIFY_ROWS']
+    conn = get_db()
+    chunk, errors, before, after, written, merged, failed = [], [], {}, {}, 0, 0, 0
+    try:
+        for index, item in enumerate(items):
+            try:
+                if isinstance(item, Exception):
+                    raise ValueError('Malformed JSON' if isinstance(item, json.JSONDecodeError) else str(item))
+                chunk.append(location_row(item))
+            except ValueError as e:
+                failed += 1
+                if len(errors) < max_errors:
+                    errors.append({'index': index, 'error': str(e)})
+                continue
+            if len(chunk) >= chunk_size:
+                merged += write_locations(conn, chunk, before, after, written + len(chunk) <= notify_limit)
+                written += len(chunk)
+                chunk = []
+    except ValueError as e:
+        conn.rollback()
+        return jsonify({'status': 'error', 'message': str(e), 'inserted': 0}), 400
+    merged += write_locations(conn, chunk, before, after, written + len(chunk) <= notify_limit)
+    written += len(chunk)
+    version = data_version(conn)
+    conn.commit()
+    if written <= notify_limit:
+        locations_changed(removed=list(before.values()), added=list(after.values()), version=version)
+    else:
+        locations_reset()
+    return jsonify({'status': 'success', 'inserted': written - merged, 'merged': merged, 'failed': failed,
+                    'errors': errors})
+
 @app.route('/get_locations')
+@cached_response
 def get_locations():
-    conn = sqlite3.connect('locations.db')
-    c = conn.cursor()
-    c.execute('SELECT id, type, lat, lon, speed, timestamp, days, time_from, time_to FROM locations')
-    rows = c.fetchall()
-    conn.close()
-    locations = [{'id': r[0], 'type': r[1], 'lat': r[2], 'lon': r[3], 'speed': r[4], 'timestamp': r[5], 'days': r[6], 'time_from': r[7], 'time_to': r[8]} for r in rows]
-    return jsonify(locations)
+    since = request.args.get('since', type=int)
+    try:
+        query, params = location_filter(request.args, since)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or time range'}), 400
+    conn = get_db()
+    if since is None and app.config['LOCATION_STORE']:
+        version, c = location_store.query(conn, request.args)
+    else:
+        c = conn.cursor()
+        # One read transaction so the version matches the rows returned
+        c.execute('BEGIN')
+        version = data_version(conn)
+        # A client ahead of this database, or behind the pruned part of the change log, reloads
+        if since is not None and not change_horizon(conn) <= since <= version:
+            conn.commit()
+            return jsonify({'version': version, 'reset': True, 'changes': [], 'deleted': []})
+        c.execute(LOCATION_SELECT + query, params)
+    if since is None:
+        fmt = request.args.get('format') or ('columnar' if request.accept_mimetypes.best_match(
+            ['application/json', COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE else 'rows')
+        if fmt == 'columnar':
+            body, mimetype = iter_columnar_json(c, app.config['STREAM_CHUNK_ROWS']), COLUMNAR_MIMETYPE
+        else:
+            body, mimetype = iter_rows_json(c, app.config['STREAM_CHUNK_ROWS']), 'application/json'
+        if request.args.get('stream') in ('1', 'true'):
+            # Rows are encoded while the cursor is read; the connection is released when the stream ends
+            response = app.response_class(stream_with_context(body), mimetype=mimetype)
+        else:
+            response = app.response_class(''.join(body), mimetype=mimetype)
+            conn.commit()
+        response.headers['X-Data-Version'] = str(version)
+        response.vary.add('Accept')
+        return response
+    locations = [location_dict(r) for r in c.fetchall()]
+    # Changed rows that were deleted or no longer match the filters are tombstones for the client
+    c.execute('SELECT location_id FROM location_changes WHERE version > ?', (since,))
+    kept = {loc['id'] for loc in locations}
+    deleted = [r[0] for r in c if r[0] not in kept]
+    conn.commit()
+    return jsonify({'version': version, 'changes': locations, 'deleted': deleted})
+
+# Stream every location matching the /get_locations filters as GeoJSON or CSV straight from
+# the cursor, in one read transaction so the file is a consistent snapshot
+@app.route('/export')
+def export():
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'status': 'error', 'message': 'format must be geojson or csv'}), 400
+    try:
+        query, params = location_filter(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or time range'}), 400
+    c = get_db().cursor()
+    c.execute('BEGIN')
+    c.execute(LOCATION_SELECT + query, params)
+    encode, mimetype = EXPORT_FORMATS[fmt]
+    response = app.response_class(stream_with_context(encode(c, app.config['STREAM_CHUNK_ROWS'])), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=locations.%s' % fmt
+    return response
+
+# Load a GeoJSON or CSV file posted as the body (format from ?format= or the content type) in
+# IMPORT_CHUNK_ROWS transactions; ?defer_indexes=1 rebuilds indexes once at the end
+@app.route('/import', methods=['POST'])
+def import_file():
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'geojson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'status': 'error', 'message': 'format must be geojson or csv'}), 400
+    result = import_locations(get_db(), iter_import(request.stream, fmt), app.config['IMPORT_CHUNK_ROWS'],
+                              request.args.get('defer_indexes') in ('1', 'true'))
+    if 'message' in result:
+        return jsonify({'status': 'error', **result}), 400
+    return jsonify({'status': 'success', **result})
+
+# One page of locations in id order after the after_id keyset cursor, with the bbox, type and
+# from/to filters of /get_locations. The rowid, or locations_type_id with a type filter, is
+# searched from after_id onwards with the bbox tested on each row, so the cost follows limit
+# over the share of rows in the bbox rather than how far the client has paged. A bbox covering
+# less than PAGE_RTREE_MAX_AREA of the district would make that walk long; it is served through
+# the R*Tree instead, sorting the few rows inside it.
+@app.route('/locations_page')
+@cached_response
+def locations_page():
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if not 0 < limit <= app.config['PAGE_MAX_ROWS']:
+        return jsonify({'status': 'error', 'message': 'limit must be between 1 and %d' % app.config['PAGE_MAX_ROWS']}), 400
+    try:
+        rtree = False
+        if request.args.get('bbox'):
+            west, south, east, north = parse_bbox(request.args['bbox'], request.args.get('zoom', type=int))
+            (bsouth, bwest), (bnorth, beast) = TANJORE_BOUNDS
+            overlap = max(min(north, bnorth) - max(south, bsouth), 0) * max(min(east, beast) - max(west, bwest), 0)
+            rtree = overlap < app.config['PAGE_RTREE_MAX_AREA'] * (bnorth - bsouth) * (beast - bwest)
+        query, params = location_filter(request.args, where=['l.id > ?'], params=[after_id], rtree=rtree)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or time range'}), 400
+    rows = get_db().execute(LOCATION_SELECT + query + ' ORDER BY l.id LIMIT ?', (*params, limit)).fetchall()
+    return jsonify({'locations': [location_dict(r) for r in rows],
+                    'next_after_id': rows[-1][0] if len(rows) == limit else None})
+
+@app.route('/clusters')
+@cached_response
+def clusters():
+    zoom = request.args.get('zoom', type=int)
+    try:
+        west, south, east, north = parse_bbox(request.args.get('bbox', ''))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox'}), 400
+    if zoom is None:
+        return jsonify({'status': 'error', 'message': 'zoom is required'}), 400
+    zoom = min(max(zoom, app.config['CLUSTER_MIN_ZOOM']), app.config['CLUSTER_MAX_ZOOM'])
+    cell = cluster_cell(zoom)
+    query = '''SELECT cx, cy, type, count, sum_lat, sum_lon FROM location_clusters
+               WHERE zoom = ? AND cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?'''
+    params = [zoom, int((west + 180) / cell), int((east + 180) / cell), int((south + 90) / cell), int((north + 90) / cell)]
+    if request.args.get('type'):
+        types = [t for t in request.args['type'].split(',') if t]
+        query += ' AND type IN (%s)' % ','.join('?' * len(types))
+        params += types
+    cells = {}
+    for cx, cy, type_, count, sum_lat, sum_lon in get_db().execute(query, params):
+        cluster = cells.setdefault((cx, cy), {'count': 0, 'sum_lat': 0.0, 'sum_lon': 0.0, 'types': {}})
+        cluster['count'] += count
+        cluster['sum_lat'] += sum_lat
+        cluster['sum_lon'] += sum_lon
+        cluster['types'][type_] = count
+    features = [{'lat': c['sum_lat'] / c['count'], 'lon': c['sum_lon'] / c['count'], 'count': c['count'], 'types': c['types']}
+                for c in cells.values()]
+    return jsonify({'zoom': zoom, 'total': sum(f['count'] for f in features), 'clusters': features})
+
+@app.route('/write_queue_stats')
+def get_write_queue_stats():
+    depth = _write_queue.qsize() if _write_queue is not None else 0
+    with _write_stats_lock:
+        stats, lost = dict(write_stats), list(lost_tickets)
+    avg = stats['total_commit_ms'] / stats['batches'] if stats['batches'] else 0.0
+    return jsonify(dict(stats, depth=depth, avg_commit_ms=avg, lost_tickets=lost))
+
+@app.route('/store_stats')
+def get_store_stats():
+    conn = get_db()
+    differing = location_store.verify(conn) if request.args.get('verify') in ('1', 'true') else None
+    location_store.ensure(conn)
+    with location_store.lock:
+        rows = location_store.size - location_store.dead
+        stats = {'rows': rows, 'deleted_slots': location_store.dead, 'capacity': len(location_store.alive),
+                 'bytes': location_store.nbytes(), 'version': location_store.version,
+                 'bytes_per_row': location_store.nbytes() / rows if rows else 0.0}
+    if differing is not None:
+        stats['verified'] = not differing
+        stats['rebuilt_columns'] = differing
+    return jsonify(stats)
+
+@app.route('/cache_stats')
+def get_cache_stats():
+    with _cache_lock:
+        return jsonify(dict(cache_stats, entries=len(_response_cache), bytes=_response_cache_bytes, version=_write_version))
+
+# Metric lines in the Prometheus text format
+def metric_lines(name, type_, help_, samples):
+    lines = ['# HELP %s %s' % (name, help_), '# TYPE %s %s' % (name, type_)]
+    for suffix, labels, value in samples:
+        label_text = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                              for k, v in labels)
+        lines.append('%s%s%s %s' % (name, suffix, '{%s}' % label_text if label_text else '', repr(value)))
+    return lines
+
+@app.route('/metrics')
+def metrics():
+    with _metrics_lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, (help_, buckets) in HISTOGRAMS.items():
+        samples = []
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = list(itertools.accumulate(values[:-2]))
+            samples += [('_bucket', labels + (('le', repr(float(bound))),), n) for bound, n in zip(buckets, cumulative)]
+            samples += [('_bucket', labels + (('le', '+Inf'),), cumulative[-1]),
+                        ('_sum', labels, values[-2]), ('_count', labels, values[-1])]
+        lines += metric_lines(name, 'histogram', help_, samples)
+    for name, help_ in COUNTERS.items():
+        lines += metric_lines(name, 'counter', help_, [('', labels, value) for (metric, labels), value
+                                                       in sorted(counters.items()) if metric == name])
+    with _cache_lock:
+        cache = dict(cache_stats, entries=len(_response_cache), bytes=_response_cache_bytes, version=_write_version)
+    with _event_cond:
+        subscribers, buffered = _subscribers, len(_events)
+    with _write_stats_lock:
+        writes = dict(write_stats)
+    lines += metric_lines('response_cache_requests_total', 'counter', 'Cached read lookups by result',
+                          [('', (('result', r),), cache[r]) for r in ('hits', 'misses', 'not_modified')])
+    lines += metric_lines('response_cache_evictions_total', 'counter', 'Cached responses evicted', [('', (), cache['evictions'])])
+    lines += metric_lines('response_cache_entries', 'gauge', 'Cached responses', [('', (), cache['entries'])])
+    lines += metric_lines('response_cache_bytes', 'gauge', 'Size of cached responses', [('', (), cache['bytes'])])
+    lines += metric_lines('data_write_version', 'gauge', 'Writes seen by this worker', [('', (), cache['version'])])
+    lines += metric_lines('write_queue_rows_total', 'counter', 'Write-behind rows by outcome',
+                          [('', (('state', s),), writes[s]) for s in ('enqueued', 'rejected', 'committed', 'failed')])
+    lines += metric_lines('write_queue_batches_total', 'counter', 'Write-behind group commits', [('', (), writes['batches'])])
+    lines += metric_lines('write_queue_retries_total', 'counter', 'Write-behind batches retried on a busy database',
+                          [('', (), writes['retries'])])
+    lines += metric_lines('write_queue_depth', 'gauge', 'Rows waiting for the write-behind writer',
+                          [('', (), _write_queue.qsize() if _write_queue is not None else 0)])
+    lines += metric_lines('events_subscribers', 'gauge', 'Open /events streams', [('', (), subscribers)])
+    lines += metric_lines('events_buffered', 'gauge', 'Events kept for Last-Event-ID replay', [('', (), buffered)])
+    lines += metric_lines('sqlite_pool_idle_connections', 'gauge', 'Pooled connections not in use', [('', (), _pool.qsize())])
+    lines += metric_lines('sqlite_open_connections', 'gauge', 'Connections open in this worker', [('', (), len(_connections))])
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>')
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.geojson')
+def tile(z, x, y):
+    if not (app.config['TILE_MIN_ZOOM'] <= z <= app.config['TILE_MAX_ZOOM'] and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'status': 'error', 'message': 'Tile out of range'}), 404
+    (south, west), (north, east) = TANJORE_BOUNDS
+    x0, y0 = lonlat_to_tile(west, north, z)
+    x1, y1 = lonlat_to_tile(east, south, z)
+    if not (x0 <= x <= x1 and y0 <= y <= y1):
+        # Only tiles over the district are cached, so the cache stays bounded
+        return app.response_class(b'{"type":"FeatureCollection","features":[]}', mimetype='application/geo+json')
+    path = tile_path(z, x, y)
+    if not os.path.exists(path):
+        conn = get_db()
+        version = data_version(conn)
+        body = render_tile(conn, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, path)
+        # A write committed while rendering may already have invalidated this tile
+        if data_version(conn) != version:
+            os.remove(path)
+            return app.response_class(body, mimetype='application/geo+json')
+    return send_file(os.path.abspath(path), mimetype='application/geo+json', max_age=app.config['TILE_MAX_AGE'])
+
+@app.route('/active_locations')
+def active_locations():
+    try:
+        at, day, minute = schedule_moment(request.args.get('at'))
+        prev_day = (day - 1) % 7
+        # Same-day window, evening part of a wrapping window, or its after-midnight part from the day before
+        query, params = location_filter(request.args, where=['''(
+            (l.day_mask & ? AND l.minute_from <= ? AND l.minute_to >= ?)
+            OR (l.minute_from > l.minute_to AND l.day_mask & ? AND l.minute_from <= ?)
+            OR (l.minute_from > l.minute_to AND l.day_mask & ? AND l.minute_to >= ?))'''],
+            params=[1 << day, minute, minute, 1 << day, minute, 1 << prev_day, minute])
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid at, bbox or time range'}), 400
+    if app.config['LOCATION_STORE']:
+        def active(cols):
+            wraps = cols['minute_from'] > cols['minute_to']
+            today = (cols['day_mask'] & (1 << day)) != 0
+            return ((today & (cols['minute_from'] <= minute) & (cols['minute_to'] >= minute))
+                    | (wraps & today & (cols['minute_from'] <= minute))
+                    | (wraps & ((cols['day_mask'] & (1 << prev_day)) != 0) & (cols['minute_to'] >= minute)))
+        _, rows = location_store.query(get_db(), request.args, active)
+        rows = rows.fetchall()
+    else:
+        rows = get_db().execute(LOCATION_SELECT + query, params)
+    return jsonify({'at': at.isoformat(), 'locations': [location_dict(r) for r in rows]})
+
+# Count, average and maximum speed per type for the bbox/type/from/to filters
+@app.route('/location_summary')
+@cached_response
+def location_summary():
+    try:
+        query, params = location_filter(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or time range'}), 400
+    if app.config['LOCATION_STORE']:
+        conn = get_db()
+        location_store.ensure(conn)
+        with location_store.lock:
+            positions = location_store.select(request.args)
+            codes = location_store.columns['type'][positions]
+            speed = location_store.columns['speed'][positions]
+            names = list(location_store.values['type'])
+        counts = np.bincount(codes, minlength=len(names))
+        sums = np.bincount(codes, weights=np.nan_to_num(speed), minlength=len(names))
+        maxima = np.full(len(names), -np.inf)
+        np.maximum.at(maxima, codes, np.nan_to_num(speed, nan=-np.inf))
+        rows = [(names[i], int(counts[i]), sums[i], maxima[i]) for i in np.flatnonzero(counts)]
+    else:
+        rows = get_db().execute('SELECT l.type, COUNT(*), TOTAL(l.speed), MAX(l.speed)' + query + ' GROUP BY l.type', params)
+    return jsonify({t: {'count': n, 'avg_speed': total / n, 'max_speed': top if top is not None and top > -math.inf else None}
+                    for t, n, total, top in rows})
+
+@app.route('/check_positions', methods=['POST'])
+def check_positions():
+    data = request.get_json(silent=True) or {}
+    try:
+        radius = float(data.get('radius', 200))
+        if not 0 < radius <= app.config['HAZARD_MAX_RADIUS_M']:
+            raise ValueError('radius must be between 0 and %d m' % app.config['HAZARD_MAX_RADIUS_M'])
+        positions = data.get('positions') or []
+        if positions and isinstance(positions[0], dict):
+            positions = [(p['vehicle_id'], p['lat'], p['lon']) for p in positions]
+        vehicle_ids = [p[0] for p in positions]
+        lat = np.array([p[1] for p in positions], dtype=np.float64)
+        lon = np.array([p[2] for p in positions], dtype=np.float64)
+        at, day, minute = schedule_moment(data.get('at'))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': 'Invalid request: %s' % e}), 400
+    hazards = hazard_index()
+    pos, haz, dist = hazards_near(hazards, lat, lon, radius)
+    active = hazards_active(hazards, haz, day, minute)
+    pos, haz, dist = pos[active], haz[active], dist[active]
+    # Group matches by position, nearest hazard first
+    order = np.lexsort((dist, pos))
+    pos, haz, dist = pos[order], haz[order], dist[order]
+    bounds = np.searchsorted(pos, np.arange(len(lat) + 1))
+    ids, types, speeds = hazards['id'][haz].tolist(), hazards['type'][haz].tolist(), hazards['speed'][haz].tolist()
+    dist = np.round(dist, 1).tolist()
+    results = []
+    for i, vehicle_id in enumerate(vehicle_ids):
+        lo, hi = bounds[i], bounds[i + 1]
+        results.append({
+            'vehicle_id': vehicle_id,
+            'speed_limit': min(speeds[lo:hi]) if hi > lo else None,
+            'hazards': [{'id': ids[j], 'type': LOCATION_TYPES[types[j]], 'distance_m': dist[j], 'speed': speeds[j]}
+                        for j in range(lo, hi)],
+        })
+    return jsonify({'at': at.isoformat(), 'radius': radius, 'results': results})
+
+@app.route('/heatmap')
+@cached_response
+def heatmap():
+    types = [t for t in request.args.get('type', '').split(',') if t] or list(LOCATION_TYPES)
+    if any(t not in LOCATION_TYPES for t in types):
+        return jsonify({'status': 'error', 'message': 'Invalid type'}), 400
+    zoom = request.args.get('zoom', app.config['HEATMAP_MIN_ZOOM'], type=int)
+    zoom = min(max(zoom, app.config['HEATMAP_MIN_ZOOM']), app.config['HEATMAP_MAX_ZOOM'])
+    south, west, cell, nrows, ncols = heatmap_grid()
+    factor = 2 ** (app.config['HEATMAP_MAX_ZOOM'] - zoom)
+    # Cell range at this zoom level covering the bbox, clipped to the grid
+    i0, j0, i1, j1 = 0, 0, nrows // factor, ncols // factor
+    if request.args.get('bbox'):
+        try:
+            bwest, bsouth, beast, bnorth = parse_bbox(request.args['bbox'])
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid bbox'}), 400
+        size = cell * factor
+        i0, i1 = max(int((bsouth - south) // size), 0), min(int((bnorth - south) // size) + 1, i1)
+        j0, j1 = max(int((bwest - west) // size), 0), min(int((beast - west) // size) + 1, j1)
+        i1, j1 = max(i1, i0), max(j1, j0)
+    grid = np.zeros((i1 - i0, j1 - j0))
+    for type_ in types:
+        counts, speeds = heatmap_for(type_)
+        base = (speeds if request.args.get('weight') == 'speed' else counts)[i0 * factor:i1 * factor, j0 * factor:j1 * factor]
+        grid += base.reshape(i1 - i0, factor, j1 - j0, factor).sum(axis=(1, 3))
+    return jsonify({'zoom': zoom, 'cell': cell * factor, 'south': south + i0 * cell * factor, 'west': west + j0 * cell * factor,
+                    'rows': i1 - i0, 'cols': j1 - j0, 'max': float(grid.max()) if grid.size else 0.0,
+                    'values': grid.ravel().tolist()})
+
+@app.route('/events')
+def events():
+    try:
+        bbox = parse_bbox(request.args['bbox'], request.args.get('zoom', type=int)) if request.args.get('bbox') else None
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or last event id'}), 400
+    with _event_cond:
+        newest = _events[-1]['id'] if _events else 0
+    # New subscribers start from now; ids from before a server restart force a reload
+    reset = last_id > newest
+    if not last_id or reset:
+        last_id = newest
+    types = {t for t in request.args.get('type', '').split(',') if t}
+    stream = event_stream(last_id, bbox, types, app.config['EVENT_HEARTBEAT'], reset)
+    return app.response_class(stream, mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/rollups')
+def rollups():
+    where, params = [], []
+    try:
+        if request.args.get('bbox'):
+            west, south, east, north = parse_bbox(request.args['bbox'])
+            cell = app.config['ROLLUP_CELL_DEG']
+            where.append('cy BETWEEN ? AND ? AND cx BETWEEN ? AND ?')
+            params += [math.floor(south / cell), math.floor(north / cell), math.floor(west / cell), math.floor(east / cell)]
+        if request.args.get('type'):
+            types = [t for t in request.args['type'].split(',') if t]
+            where.append('type IN (%s)' % ','.join('?' * len(types)))
+            params += types
+        if request.args.get('from'):
+            where.append('day >= ?')
+            params.append(datetime.fromisoformat(request.args['from']).date().isoformat())
+        if request.args.get('to'):
+            where.append('day <= ?')
+            params.append(datetime.fromisoformat(request.args['to']).date().isoformat())
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid bbox or date range'}), 400
+    rows = get_db().execute('SELECT day, type, count, sum_speed, max_speed, sum_lat, sum_lon FROM location_rollups' +
+                            (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY day', params)
+    return jsonify([{'day': r[0], 'type': r[1], 'count': r[2], 'avg_speed': r[3] / r[2], 'max_speed': r[4],
+                     'lat': r[5] / r[2], 'lon': r[6] / r[2]} for r in rows])
+
+# Mean, standard deviation, minimum and maximum speed read from speed_stats only: per type, or
+# per type and grid cell (by=cell) or hour of week (by=hour, 0 being Monday 00:00 local time).
+# A bbox selects every cell it touches.
+@app.route('/speed_stats')
+@cached_response
+def speed_stats():
+    group = {'': '', 'cell': ', cy, cx', 'hour': ', how'}.get(request.args.get('by', ''))
+    if group is None:
+        return jsonify({'status': 'error', 'message': 'by must be cell or hour'}), 400
+    conn = get_db()
+    cell, = conn.execute('SELECT cell FROM speed_stats_grid').fetchone()
+    where, params = [], []
+    if request.args.get('bbox'):
+        try:
+            west, south, east, north = parse_bbox(request.args['bbox'])
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid bbox'}), 400
+        where.append('cy BETWEEN ? AND ? AND cx BETWEEN ? AND ?')
+        params += [int((south + 90) / cell), int((north + 90) / cell), int((west + 180) / cell), int((east + 180) / cell)]
+    if request.args.get('type'):
+        types = [t for t in request.args['type'].split(',') if t]
+        where.append('type IN (%s)' % ','.join('?' * len(types)))
+        params += types
+    rows = conn.execute('SELECT type%s, SUM(count), SUM(sum_speed), SUM(sum_sq), MIN(min_speed), MAX(max_speed) '
+                        'FROM speed_stats%s GROUP BY type%s' % (group, ' WHERE ' + ' AND '.join(where) if where else '', group),
+                        params).fetchall()
+    result = []
+    for r in rows:
+        n, total, squares, low, high = r[-5:]
+        mean = total / n
+        stats = {'type': r[0], 'count': n, 'avg_speed': mean, 'stddev_speed': math.sqrt(max(squares / n - mean * mean, 0.0)),
+                 'min_speed': low, 'max_speed': high}
+        if group == ', cy, cx':
+            stats.update(lat=(r[1] + 0.5) * cell - 90, lon=(r[2] + 0.5) * cell - 180)
+        elif group:
+            stats['hour_of_week'] = r[1]
+        result.append(stats)
+    return jsonify(result)
 
 @app.route('/update_location', methods=['POST'])
 def update_location():
     data = request.get_json()
-    conn = sqlite3.connect('locations.db')
-    c = conn.cursor()
-    c.execute('UPDATE locations SET type=?, lat=?, lon=?, speed=?, timestamp=?, days=?, time_from=?, time_to=? WHERE id=?',
-              (data['type'], data['lat'], data['lon'], float(data['speed']), data['timestamp'], data['days'], data['time_from'], data['time_to'], data['id']))
+    try:
+        row = location_row(data)
+        location_id = int(data['id'])
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except (KeyError, TypeError):
+        return jsonify({'status': 'error', 'message': 'id is required'}), 400
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    old = fetch_location(conn, location_id)
+    conn.execute(UPDATE_LOCATION_SQL, (*row, location_id))
+    version = data_version(conn)
     conn.commit()
-    conn.close()
+    if old:
+        new = {'id': location_id, **dict(zip(LOCATION_FIELDS, row)), 'report_count': old['report_count']}
+        locations_changed(removed=[old], added=[new], version=version)
     return jsonify({'status': 'success'})
 
 @app.route('/delete_location', methods=['POST'])
 def delete_location():
-    data = request.get_json()
-    conn = sqlite3.connect('locations.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM locations WHERE id=?', (data['id'],))
+    data = request.get_json(silent=True)
+    try:
+        location_id = int(data['id'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'id is required'}), 400
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    old = fetch_location(conn, location_id)
+    conn.execute('DELETE FROM locations WHERE id=?', (location_id,))
+    version = data_version(conn)
     conn.commit()
-    conn.close()
+    if old:
+        locations_changed(removed=[old], version=version)
     return jsonify({'status': 'success'})
 
+# Partial update: only the supplied fields are written, so triggers on untouched
+# columns (R*Tree, clusters) do not fire
+@app.route('/locations/<int:location_id>', methods=['PATCH'])
+def patch_location(location_id):
+    data = request.get_json(silent=True)
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    old = fetch_location(conn, location_id)
+    if not old:
+        conn.rollback()
+        return jsonify({'status': 'error', 'message': 'Location not found'}), 404
+    try:
+        columns = patch_columns(old, data)
+    except ValueError as e:
+        conn.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    conn.execute('UPDATE locations SET %s WHERE id=?' % ', '.join(c + '=?' for c in columns),
+                 (*columns.values(), location_id))
+    version = data_version(conn)
+    conn.commit()
+    new = {**old, **{f: columns[f] for f in LOCATION_FIELDS if f in columns}}
+    locations_changed(removed=[old], added=[new], version=version)
+    return jsonify({'status': 'success', 'location': new})
+
+# Filters of a bulk request: bbox, type, from and to as on /get_locations, at least one required
+def bulk_filter():
+    if not any(request.args.get(k) for k in ('bbox', 'type', 'from', 'to')):
+        raise ValueError('A bbox, type, from or to filter is required')
+    args = request.args.copy()
+    args.pop('zoom', None)
+    try:
+        return location_filter(args)
+    except ValueError:
+        raise ValueError('Invalid bbox or time range')
+
+# Set-based bulk update and delete of every location matching the filters, each one
+# statement in one transaction. Up to BULK_NOTIFY_ROWS rows the old and new rows are
+# passed to the derived caches; larger changes reset them.
+@app.route('/locations', methods=['PATCH', 'DELETE'])
+def bulk_locations():
+    data = request.get_json(silent=True) if request.method == 'PATCH' else None
+    try:
+        query, params = bulk_filter()
+        if request.method == 'PATCH':
+            if isinstance(data, dict) and set(data) - set(BULK_PATCH_FIELDS):
+                raise ValueError('Bulk updates can only set %s' % ', '.join(BULK_PATCH_FIELDS))
+            if isinstance(data, dict) and 0 < len(set(SCHEDULE_FIELDS) & set(data)) < len(SCHEDULE_FIELDS):
+                raise ValueError('days, time_from and time_to must be set together')
+            # Validated over a neutral row; only the supplied fields reach the UPDATE
+            columns = patch_columns({'type': LOCATION_TYPES[0], 'lat': 0, 'lon': 0, 'speed': 0}, data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    notify_limit = app.config['BULK_NOTIFY_ROWS']
+    ids = 'WHERE id IN (SELECT l.id' + query + ')'
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    old = conn.execute(LOCATION_SELECT + query + ' LIMIT ?',
+                       (*params, notify_limit + 1)).fetchall()
+    notify = len(old) <= notify_limit
+    if request.method == 'PATCH':
+        sql = 'UPDATE locations SET %s %s' % (', '.join(c + '=?' for c in columns), ids)
+        params = (*columns.values(), *params)
+    else:
+        sql = 'DELETE FROM locations ' + ids
+    cursor = conn.execute(sql + (' RETURNING ' + LOCATION_COLUMNS if notify else ''), params)
+    new = [location_dict(r) for r in cursor.fetchall()] if notify else []
+    affected = len(new) if notify else cursor.rowcount
+    version = data_version(conn)
+    conn.commit()
+    if notify:
+        locations_changed(removed=[location_dict(r) for r in old],
+                          added=new if request.method == 'PATCH' else (), version=version)
+    else:
+        locations_reset()
+    return jsonify({'status': 'success', 'updated' if request.method == 'PATCH' else 'deleted': affected})
+
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+
+# Recompute speed_stats from locations and report the rows where the trigger-maintained
+# aggregates differed from the recomputed ones
+@app.cli.command('rebuild-speed-stats')
+def rebuild_speed_stats_command():
+    query = 'SELECT type, cy, cx, how, count, sum_speed, sum_sq, min_speed, max_speed FROM speed_stats'
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        before = {r[:4]: r[4:] for r in conn.execute(query)}
+        start = time.perf_counter()
+        rebuild_speed_stats(conn)
+        elapsed = time.perf_counter() - start
+        after = {r[:4]: r[4:] for r in conn.execute(query)}
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _connections.discard(conn)
+        conn.close()
+    # Sums are compared with a tolerance for the rounding accumulated by incremental updates
+    drifted = sorted(key for key in before.keys() | after.keys()
+                     if before.get(key) is None or after.get(key) is None
+                     or not all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(before[key], after[key])))
+    click.echo('Rebuilt %d speed_stats rows in %.1fs; %d differed' % (len(after), elapsed, len(drifted)))
+    for key in drifted[:20]:
+        click.echo('  %s: %s -> %s' % (key, before.get(key), after.get(key)))
+
+# Load a GeoJSON or CSV export, e.g. from another district server. Caches of running
+# workers reload after their next own write, as with apply-retention.
+@app.cli.command('import-locations')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), help='Default from the file extension')
+@click.option('--chunk-rows', type=int, help='Rows per transaction (default IMPORT_CHUNK_ROWS)')
+@click.option('--defer-indexes', is_flag=True, help='Drop indexes during the load and rebuild them once at the end')
+def import_locations_command(path, fmt, chunk_rows, defer_indexes):
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'geojson')
+    conn = connect_db()
+    try:
+        with open(path, 'rb') as f:
+            result = import_locations(conn, iter_import(f, fmt), chunk_rows or app.config['IMPORT_CHUNK_ROWS'], defer_indexes)
+    finally:
+        _connections.discard(conn)
+        conn.close()
+    click.echo('Imported %d rows (%d failed) in %.1fs, %.0f rows/s' % (
+        result['imported'], result['failed'], result['seconds'], result['rows_per_second']))
+    for error in result['errors'][:20]:
+        click.echo('  row %d: %s' % (error['index'], error['error']))
+    if 'message' in result:
+        raise click.ClickException(result['message'])
+
+# Run retention once, e.g. from cron. Caches of running workers only see the deletes
+# after their next own write, so prefer RETENTION_DAYS in the server when caching is on.
+@app.cli.command('apply-retention')
+@click.option('--days', type=int, help='Keep this many days of raw points (default RETENTION_DAYS)')
+def apply_retention_command(days):
+    days = app.config['RETENTION_DAYS'] if days is None else days
+    if days <= 0:
+        raise click.UsageError('Set --days or RETENTION_DAYS to a positive number of days')
+    start = time.perf_counter()
+    removed = apply_retention(int(time.time()) - days * 86400)
+    click.echo('Rolled up and deleted %d points in %.1fs' % (removed, time.perf_counter() - start))
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,11 @@
+// Self-hosted replacements for the CDN tags in app.py's HTML_TEMPLATE.
+// Built by `npm run build` into static/dist and served from /assets.
+import * as L from 'leaflet';
+import 'leaflet/dist/leaflet.css';
+import '@fortawesome/fontawesome-free/css/all.min.css';
+import '@fontsource/roboto/400.css';
+import '@fontsource/roboto/500.css';
+import '@fontsource/roboto/700.css';
+import './main.css';
+
+window.L = L;
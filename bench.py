@@ -0,0 +1,265 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from app import app, connect_db, init_db, insert_locations, location_row, TANJORE_BOUNDS
+
+# Share of each type in seeded data, and the schedules each type is drawn from
+TYPE_WEIGHTS = {'accidents': 0.4, 'crowded': 0.3, 'schools': 0.2, 'hospitals': 0.1}
+SCHEDULES = {
+    'accidents': [('', '', ''), ('Everyday', '18:00', '23:00'), ('Saturday,Sunday', '22:00', '02:00')],
+    'crowded': [('Everyday', '08:00', '10:00'), ('Everyday', '17:00', '20:00'), ('Friday,Saturday', '19:00', '01:00')],
+    'schools': [('Monday,Tuesday,Wednesday,Thursday,Friday', '08:00', '16:30'), ('Monday,Wednesday,Friday', '07:30', '12:00')],
+    'hospitals': [('Everyday', '00:00', '23:59'), ('', '', '')],
+}
+SEED_CHUNK = 20000
+
+# Random location inside the Tanjore bounds with a type-appropriate schedule
+def synthetic_location(rng, start):
+    type_ = rng.choices(list(TYPE_WEIGHTS), weights=list(TYPE_WEIGHTS.values()))[0]
+    (south, west), (north, east) = TANJORE_BOUNDS
+    days, time_from, time_to = rng.choice(SCHEDULES[type_])
+    return {
+        'type': type_, 'lat': rng.uniform(south, north), 'lon': rng.uniform(west, east),
+        'speed': round(rng.uniform(10, 80), 1),
+        'timestamp': (start + timedelta(seconds=rng.randrange(180 * 86400))).isoformat(),
+        'days': days, 'time_from': time_from, 'time_to': time_to,
+    }
+
+# Fill a fresh database with size synthetic rows
+def seed(size, rng):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    init_db()
+    conn = connect_db()
+    for offset in range(0, size, SEED_CHUNK):
+        rows = [location_row(synthetic_location(rng, start)) for _ in range(min(SEED_CHUNK, size - offset))]
+        insert_locations(conn, rows)
+        conn.commit()
+    conn.close()
+
+# Requests exercised per dataset size: name -> (method, path, body factory or None, requests factor)
+def scenarios(size, rng):
+    (south, west), (north, east) = TANJORE_BOUNDS
+    ids = list(range(1, size + 1))
+    rng.shuffle(ids)
+    deletable = iter(ids)
+
+    def viewport():
+        lat, lon = rng.uniform(south, north - 0.1), rng.uniform(west, east - 0.1)
+        return '%f,%f,%f,%f' % (lon, lat, lon + 0.1, lat + 0.1)
+
+    def new_location():
+        return synthetic_location(rng, datetime.now(timezone.utc))
+
+    def changed_location():
+        return dict(new_location(), id=rng.choice(ids))
+
+    return {
+        'index': ('GET', lambda: '/', None, 1),
+        'get_locations_full': ('GET', lambda: '/get_locations', None, 0.1),
+        'get_locations_bbox': ('GET', lambda: '/get_locations?bbox=' + viewport(), None, 1),
+        'locations_page': ('GET', lambda: '/locations_page?limit=100&after_id=%d' % rng.randrange(size), None, 1),
+        'add_location': ('POST', lambda: '/add_location', new_location, 1),
+        'update_location': ('POST', lambda: '/update_location', changed_location, 1),
+        'patch_location': ('PATCH', lambda: '/locations/%d' % rng.choice(ids), lambda: {'speed': round(rng.uniform(10, 80), 1)}, 1),
+        'delete_location': ('POST', lambda: '/delete_location', lambda: {'id': next(deletable)}, 1),
+    }
+
+# Percentile of an already sorted list
+def percentile(values, p):
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)] if values else 0.0
+
+# Summary statistics for one scenario run
+def summarize(latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        'requests': len(latencies), 'errors': errors,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+# Current resident set size in MB; without /proc only the process lifetime peak is available
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Run a scenario while sampling RSS, adding its peak and growth over the RSS it started with
+def measure_rss(run, interval=0.01):
+    start = peak = rss_mb()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(interval):
+            peak = max(peak, rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        stats = run()
+    finally:
+        done.set()
+        sampler.join()
+    peak = max(peak, rss_mb())
+    return dict(stats, peak_rss_mb=peak, rss_growth_mb=peak - start)
+
+# Drive one scenario through the Flask test client, sequentially
+def run_test_client(client, method, path, body, count):
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for _ in range(count):
+        url, payload = path(), body() if body else None
+        t = time.perf_counter()
+        response = client.open(url, method=method, json=payload)
+        response.get_data()
+        latencies.append(time.perf_counter() - t)
+        errors += response.status_code >= 400
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+# Drive one scenario over HTTP against a local threaded server with concurrent clients
+def run_http(base, method, path, body, count, concurrency):
+    lock = threading.Lock()
+    requests = [(path(), body() if body else None) for _ in range(count)]
+    latencies, errors = [], [0]
+
+    def send(request):
+        url, payload = request
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(base + url, data=data, method=method, headers={'Content-Type': 'application/json'})
+        t = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req) as response:
+                response.read()
+            failed = False
+        except OSError:
+            failed = True
+        with lock:
+            latencies.append(time.perf_counter() - t)
+            errors[0] += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, requests))
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+# Start the app on an ephemeral port in a background thread
+def start_server():
+    from werkzeug.serving import make_server
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Print relative changes against an earlier results file, flagging regressions beyond threshold
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for key, current in results['runs'].items():
+        previous = baseline['runs'].get(key)
+        if not previous:
+            continue
+        for metric, worse_if_higher in (('throughput_rps', False), ('p95_ms', True), ('p99_ms', True)):
+            old, new = previous[metric], current[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            regressed = change > threshold if worse_if_higher else change < -threshold
+            regressions += regressed
+            print('%-40s %-15s %10.2f -> %10.2f  %+6.1f%%%s' % (key, metric, old, new, change * 100, '  REGRESSION' if regressed else ''))
+    return regressions
+
+# Seed one dataset size and run every selected scenario against it
+def run_size(size, args, workdir):
+    rng = random.Random(args.seed)
+    app.config['DATABASE'] = os.path.join(workdir, 'bench-%d.db' % size)
+    t = time.perf_counter()
+    seed(size, rng)
+    print('seeded %d rows in %.1fs' % (size, time.perf_counter() - t), flush=True)
+    runs = scenarios(size, rng)
+    selected = args.scenarios.split(',') if args.scenarios else list(runs)
+    server = start_server() if args.http else None
+    client = app.test_client()
+    results = {}
+    for name in selected:
+        method, path, body, factor = runs[name]
+        count = max(int(args.requests * factor), 5)
+        modes = [('test_client', lambda: run_test_client(client, method, path, body, count))]
+        if server:
+            base = 'http://127.0.0.1:%d' % server.server_port
+            modes.append(('http', lambda: run_http(base, method, path, body, count, args.concurrency)))
+        for mode, run in modes:
+            stats = measure_rss(run)
+            key = '%s/%d/%s' % (name, size, mode)
+            results[key] = stats
+            print('%-40s %8.1f req/s  p50 %7.2f  p95 %7.2f  p99 %7.2f ms  rss %6.1f MB (%+.1f)  errors %d' % (
+                key, stats['throughput_rps'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                stats['peak_rss_mb'], stats['rss_growth_mb'], stats['errors']), flush=True)
+    if server:
+        server.shutdown()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for the dashboard routes')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated dataset sizes, up to 1000000')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--scenarios', help='comma-separated subset of scenarios to run')
+    parser.add_argument('--http', action='store_true', help='also drive a local HTTP server')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--cache', action='store_true', help='keep the in-process response cache enabled')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        # Each size runs in its own process so pooled connections, in-process caches
+        # and memory never carry over from a smaller dataset
+        if args.worker:
+            app.config['TILE_CACHE_DIR'] = os.path.join(workdir, 'tiles')
+            if not args.cache:
+                app.config['RESPONSE_CACHE_BYTES'] = 0
+            with open(args.output, 'w') as f:
+                json.dump(run_size(args.worker, args, workdir), f)
+            return 0
+        results = {'started': datetime.now(timezone.utc).isoformat(), 'python': sys.version.split()[0],
+                   'platform': platform.platform(), 'args': vars(args), 'runs': {}}
+        worker_args = list(argv if argv is not None else sys.argv[1:])
+        for size in (int(s) for s in args.sizes.split(',')):
+            output = os.path.join(workdir, 'runs-%d.json' % size)
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + worker_args +
+                           ['--worker', str(size), '--output', output], check=True)
+            with open(output) as f:
+                results['runs'].update(json.load(f))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to %s' % args.output)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
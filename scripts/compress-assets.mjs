@@ -0,0 +1,34 @@
+// Write .br and .gz siblings next to compressible build output so Flask can serve
+// them without compressing per request. Variants that do not save space are skipped.
+import { readdirSync, readFileSync, statSync, writeFileSync } from 'node:fs';
+import { join, extname } from 'node:path';
+import { brotliCompressSync, gzipSync, constants } from 'node:zlib';
+
+const root = process.argv[2] || 'static/dist';
+const compressible = new Set(['.js', '.css', '.svg', '.json', '.ttf', '.eot', '.html', '.map']);
+
+function* walk(dir) {
+  for (const name of readdirSync(dir)) {
+    const path = join(dir, name);
+    if (statSync(path).isDirectory()) yield* walk(path);
+    else yield path;
+  }
+}
+
+let original = 0, brotli = 0, gzip = 0;
+for (const path of walk(root)) {
+  if (!compressible.has(extname(path))) continue;
+  const data = readFileSync(path);
+  const br = brotliCompressSync(data, { params: { [constants.BROTLI_PARAM_QUALITY]: 11 } });
+  const gz = gzipSync(data, { level: 9 });
+  original += data.length;
+  if (br.length < data.length) {
+    writeFileSync(path + '.br', br);
+    brotli += br.length;
+  }
+  if (gz.length < data.length) {
+    writeFileSync(path + '.gz', gz);
+    gzip += gz.length;
+  }
+}
+console.log(`compressed ${original} bytes to ${brotli} (br) / ${gzip} (gzip)`);
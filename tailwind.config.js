@@ -0,0 +1,8 @@
+// Classes are used in HTML_TEMPLATE and in the markup its script builds
+module.exports = {
+  content: ['./app.py'],
+  theme: {
+    extend: {}
+  },
+  plugins: []
+};
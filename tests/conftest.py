@@ -0,0 +1,25 @@
+import pytest
+
+import app as dashboard
+
+# Close every connection, pooled ones included, and forget the derived caches
+def reset():
+    dashboard.close_db()
+    while not dashboard._pool.empty():
+        dashboard._pool.get_nowait()
+    dashboard.location_store.clear()
+    dashboard._heatmaps.clear()
+    dashboard._hazards = None
+
+# App bound to a fresh database, with the in-process caches of earlier tests dropped
+@pytest.fixture
+def client(tmp_path):
+    app = dashboard.app
+    saved = {k: app.config[k] for k in ('DATABASE', 'TILE_CACHE_DIR', 'RESPONSE_CACHE_BYTES')}
+    app.config.update(DATABASE=str(tmp_path / 'locations.db'), TILE_CACHE_DIR=str(tmp_path / 'tiles'),
+                      RESPONSE_CACHE_BYTES=0)
+    reset()
+    dashboard.init_db()
+    yield app.test_client()
+    reset()
+    app.config.update(saved)
@@ -0,0 +1,16 @@
+import json
+
+import app as dashboard
+
+SCHOOL = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+def test_ndjson_line_too_large_is_skipped(client, monkeypatch):
+    monkeypatch.setattr(dashboard, 'MAX_JSON_ELEMENT', 1000)
+    line = json.dumps(SCHOOL).encode()
+    huge = json.dumps(dict(SCHOOL, note='x' * 200000)).encode()
+    body = b'\n'.join([line, huge, b'{"also": "skipped"', line]) + b'\n'
+    r = client.post('/add_locations', data=body, content_type='application/x-ndjson')
+    assert r.status_code == 200
+    assert (r.json['inserted'], r.json['failed']) == (2, 2)
+    assert r.json['errors'][0] == {'index': 1, 'error': 'NDJSON line too large'}
+    assert r.json['errors'][1] == {'index': 2, 'error': 'Malformed JSON'}
@@ -0,0 +1,61 @@
+import math
+import random
+
+import app as dashboard
+
+SPEED_STATS = 'SELECT type, cy, cx, how, count, sum_speed, sum_sq, min_speed, max_speed FROM speed_stats'
+CLUSTERS = 'SELECT zoom, cx, cy, type, count, sum_lat, sum_lon FROM location_clusters'
+
+# A location in a small area, so cells collect several points and min/max get removed
+def random_location(rng):
+    return {'type': rng.choice(dashboard.LOCATION_TYPES), 'lat': 10.8 + rng.uniform(-0.02, 0.02),
+            'lon': 79.1 + rng.uniform(-0.02, 0.02), 'speed': round(rng.uniform(0, 80), 2),
+            'timestamp': '2024-01-%02dT%02d:%02d:00+05:30' % (rng.randint(1, 7), rng.randint(0, 23), rng.randint(0, 59))}
+
+# Trigger-maintained rows and the rows recomputed from locations, keyed on their primary key
+def incremental_and_rebuilt(query, rebuild):
+    conn = dashboard.connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        before = {r[:4]: r[4:] for r in conn.execute(query)}
+        rebuild(conn)
+        after = {r[:4]: r[4:] for r in conn.execute(query)}
+    finally:
+        conn.rollback()
+        dashboard._connections.discard(conn)
+        conn.close()
+    return before, after
+
+def assert_same(before, after):
+    assert before.keys() == after.keys()
+    for key in before:
+        assert all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(before[key], after[key])), key
+
+def test_random_writes_keep_aggregates_exact(client):
+    rng = random.Random(20240101)
+    ids = []
+    for _ in range(300):
+        op = rng.random()
+        if op < 0.35 or not ids:
+            client.post('/add_location', json=random_location(rng))
+        elif op < 0.45:
+            client.post('/add_locations', json=[random_location(rng) for _ in range(rng.randint(2, 5))])
+        elif op < 0.6:
+            client.post('/update_location', json=dict(random_location(rng), id=rng.choice(ids)))
+        elif op < 0.75:
+            field = rng.choice(('type', 'lat', 'lon', 'speed', 'timestamp'))
+            client.patch('/locations/%d' % rng.choice(ids), json={field: random_location(rng)[field]})
+        elif op < 0.8:
+            client.patch('/locations?type=' + rng.choice(dashboard.LOCATION_TYPES),
+                         json={'speed': round(rng.uniform(0, 80), 2)})
+        elif op < 0.95:
+            client.post('/delete_location', json={'id': rng.choice(ids)})
+        else:
+            lat, lon = 10.8 + rng.uniform(-0.02, 0.02), 79.1 + rng.uniform(-0.02, 0.02)
+            client.delete('/locations?bbox=%f,%f,%f,%f' % (lon - 0.003, lat - 0.003, lon + 0.003, lat + 0.003))
+        ids = [r['id'] for r in client.get('/get_locations').json]
+    assert client.get('/get_locations').json
+    assert_same(*incremental_and_rebuilt(SPEED_STATS, dashboard.rebuild_speed_stats))
+    levels = [(z, dashboard.cluster_cell(z)) for z in range(dashboard.app.config['CLUSTER_MIN_ZOOM'],
+                                                           dashboard.app.config['CLUSTER_MAX_ZOOM'] + 1)]
+    assert_same(*incremental_and_rebuilt(CLUSTERS, lambda conn: dashboard.rebuild_clusters(conn, levels)))
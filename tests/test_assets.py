@@ -0,0 +1,50 @@
+import gzip
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import app as dashboard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A vite build output as `npm run build` lays it out, compressed by the real compress-assets script
+@pytest.fixture
+def dist(client, tmp_path, monkeypatch):
+    if shutil.which('node') is None:
+        pytest.skip('node is not installed')
+    out = tmp_path / 'dist'
+    out.mkdir()
+    (out / 'main-3f2a1b.js').write_text('window.L = {};\n' * 200)
+    (out / 'main-9c8d7e.css').write_text('.sidebar { color: #e0e0e0; }\n' * 200)
+    (out / 'roboto-latin-400-normal-a1b2c3.woff2').write_bytes(os.urandom(512))
+    (out / 'manifest.json').write_text(json.dumps({'assets/main.js': {
+        'file': 'main-3f2a1b.js', 'src': 'assets/main.js', 'isEntry': True, 'css': ['main-9c8d7e.css']}}))
+    subprocess.run(['node', os.path.join(ROOT, 'scripts', 'compress-assets.mjs'), str(out)], check=True, capture_output=True)
+    monkeypatch.setitem(dashboard.app.config, 'ASSET_DIR', str(out))
+    monkeypatch.setattr(dashboard, '_index_page', None)
+    return out
+
+def test_page_links_the_built_bundle(client, dist):
+    page = client.get('/', headers={'Accept-Encoding': 'identity'}).get_data(as_text=True)
+    assert '<script type="module" src="/assets/main-3f2a1b.js">' in page
+    assert '<link rel="stylesheet" href="/assets/main-9c8d7e.css">' in page
+    assert 'cdn.tailwindcss.com' not in page
+
+def test_assets_serve_the_accepted_variant(client, dist):
+    plain = (dist / 'main-3f2a1b.js').read_bytes()
+    r = client.get('/assets/main-3f2a1b.js', headers={'Accept-Encoding': 'br, gzip'})
+    assert r.headers['Content-Encoding'] == 'br'
+    assert r.data == (dist / 'main-3f2a1b.js.br').read_bytes()
+    assert 'immutable' in r.headers['Cache-Control']
+    r = client.get('/assets/main-3f2a1b.js', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip' and gzip.decompress(r.data) == plain
+    r = client.get('/assets/main-3f2a1b.js', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers and r.data == plain
+    # Fonts are not compressible and have no variants
+    assert not (dist / 'roboto-latin-400-normal-a1b2c3.woff2.gz').exists()
+    r = client.get('/assets/roboto-latin-400-normal-a1b2c3.woff2', headers={'Accept-Encoding': 'br, gzip'})
+    assert 'Content-Encoding' not in r.headers and r.mimetype == 'font/woff2'
+    assert client.get('/assets/../app.py').status_code == 404
@@ -0,0 +1,103 @@
+import math
+import random
+
+import pytest
+
+import app as dashboard
+
+SCHOOL = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+def nearby(client, lat=10.8, lon=79.1):
+    result, = client.post('/check_positions', json={'positions': [['bus', lat, lon]], 'radius': 100}).json['results']
+    return result['hazards']
+
+def test_writes_from_other_processes_are_seen(client):
+    client.post('/add_location', json=SCHOOL)
+    assert len(nearby(client)) == 1
+    # Committed without telling this process, as another worker would
+    conn = dashboard.connect_db()
+    conn.execute('UPDATE locations SET speed = 15')
+    conn.commit()
+    assert [h['speed'] for h in nearby(client)] == [15]
+    conn.execute('DELETE FROM locations')
+    conn.commit()
+    assert nearby(client) == []
+
+# Whether a schedule is active at a weekday (0 is Monday) and minute of day, evaluated from the raw fields
+def scheduled(location, day, minute):
+    days = location['days'] or 'Everyday'
+    on = lambda d: days == 'Everyday' or dashboard.DAYS_OF_WEEK[d % 7] in days.split(',')
+    if not location['time_from'] and not location['time_to']:
+        return on(day)
+    start, end = (dashboard.parse_minute(location[f] or default)
+                  for f, default in (('time_from', '00:00'), ('time_to', '23:59')))
+    if start <= end:
+        return on(day) and start <= minute <= end
+    return on(day) and minute >= start or on(day - 1) and minute <= end
+
+def distance_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * dashboard.EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def random_schedule(rng):
+    kind = rng.random()
+    if kind < 0.2:
+        return {}
+    days = ','.join(rng.sample(dashboard.DAYS_OF_WEEK, rng.randint(1, 3)))
+    if kind < 0.3:
+        return {'days': days}
+    start, end = rng.randrange(0, 1440, 15), rng.randrange(0, 1440, 15)
+    # Half of the timed windows wrap past midnight
+    if kind < 0.65:
+        start, end = max(start, end), min(start, end)
+    return {'days': days, 'time_from': '%02d:%02d' % divmod(start, 60), 'time_to': '%02d:%02d' % divmod(end, 60)}
+
+@pytest.fixture
+def scheduled_hazards(client):
+    rng = random.Random(7)
+    locations = [dict(SCHOOL, type=rng.choice(dashboard.LOCATION_TYPES), speed=rng.randint(10, 60),
+                      lat=10.8 + rng.uniform(-0.01, 0.01), lon=79.1 + rng.uniform(-0.01, 0.01), **random_schedule(rng))
+                 for _ in range(300)]
+    # A Monday night window seen on Tuesday morning, and a Sunday night one seen on Monday morning
+    locations += [dict(SCHOOL, days='Monday', time_from='22:00', time_to='02:00'),
+                  dict(SCHOOL, days='Sunday', time_from='23:00', time_to='01:00')]
+    client.post('/add_locations', json=locations)
+    return client.get('/get_locations').json
+
+# Past midnight on the day after each night window, inside and at the end of one, midday, and a UTC
+# time that is already the next day in SCHEDULE_TIMEZONE
+MOMENTS = ['2024-01-02T01:30:00+05:30', '2024-01-01T00:30:00+05:30', '2024-01-01T22:30:00+05:30',
+           '2024-01-07T23:59:00+05:30', '2024-01-03T12:00:00+05:30', '2024-01-01T20:00:00Z']
+
+@pytest.mark.parametrize('at', MOMENTS)
+def test_check_positions_matches_brute_force(client, scheduled_hazards, at):
+    rng = random.Random(at)
+    radius = 400
+    positions = [['v%d' % i, 10.8 + rng.uniform(-0.012, 0.012), 79.1 + rng.uniform(-0.012, 0.012)] for i in range(40)]
+    positions.append(['origin', 10.8, 79.1])
+    results = client.post('/check_positions', json={'positions': positions, 'radius': radius, 'at': at}).json['results']
+    _, day, minute = dashboard.schedule_moment(at)
+    for (vehicle_id, lat, lon), result in zip(positions, results):
+        assert result['vehicle_id'] == vehicle_id
+        expected = {h['id']: distance_m(lat, lon, h['lat'], h['lon']) for h in scheduled_hazards
+                    if scheduled(h, day, minute)}
+        found = {h['id']: h['distance_m'] for h in result['hazards']}
+        # Points within rounding of the radius may fall either way
+        assert {i for i, d in expected.items() if d < radius - 0.5} <= found.keys()
+        assert {i for i, d in expected.items() if d <= radius + 0.5} >= found.keys()
+        for location_id, d in found.items():
+            assert d == pytest.approx(expected[location_id], abs=0.5)
+        assert [h['distance_m'] for h in result['hazards']] == sorted(found.values())
+    # The two night windows at the origin, by the moments they cover
+    origin = {h['id'] for h in results[-1]['hazards']} & {301, 302}
+    assert origin == {MOMENTS[0]: {301}, MOMENTS[2]: {301}, MOMENTS[5]: {301},
+                      MOMENTS[1]: {302}, MOMENTS[3]: {302}}.get(at, set())
+
+@pytest.mark.parametrize('store', [True, False])
+@pytest.mark.parametrize('at', MOMENTS)
+def test_active_locations_matches_brute_force(client, scheduled_hazards, monkeypatch, store, at):
+    monkeypatch.setitem(dashboard.app.config, 'LOCATION_STORE', store)
+    _, day, minute = dashboard.schedule_moment(at)
+    expected = {h['id'] for h in scheduled_hazards if scheduled(h, day, minute)}
+    assert {loc['id'] for loc in client.get('/active_locations', query_string={'at': at}).json['locations']} == expected
@@ -0,0 +1,38 @@
+import app as dashboard
+
+SCHOOL = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+# Heatmap values for every type, count- and speed-weighted
+def heatmaps(client):
+    return {(type_, weight): client.get('/heatmap?type=%s&weight=%s' % (type_, weight)).json['values']
+            for type_ in dashboard.LOCATION_TYPES for weight in ('count', 'speed')}
+
+# Heatmap values from grids read afresh from the table
+def rebuilt(client):
+    dashboard._heatmaps.clear()
+    return heatmaps(client)
+
+def test_incremental_grids_match_rebuild(client):
+    heatmaps(client)
+    client.post('/add_location', json=SCHOOL)
+    client.post('/add_location', json=dict(SCHOOL, type='accidents', lat=10.79, speed=12.5))
+    client.patch('/locations/1', json={'speed': 42.75})
+    client.patch('/locations?type=accidents', json={'type': 'crowded', 'speed': 7.25})
+    incremental = heatmaps(client)
+    assert any(incremental[('crowded', 'speed')])
+    assert incremental == rebuilt(client)
+    client.delete('/locations?type=crowded')
+    incremental = heatmaps(client)
+    assert incremental == rebuilt(client)
+
+def test_write_committed_before_build_is_not_counted_twice(client):
+    conn = dashboard.connect_db()
+    row = dashboard.location_row(SCHOOL)
+    location_id, = dashboard.insert_locations(conn, [row])
+    version = dashboard.data_version(conn)
+    conn.commit()
+    # The grid is read after the commit but before the write's callback runs
+    before = heatmaps(client)
+    dashboard.locations_changed(added=[{'id': location_id, **dict(zip(dashboard.LOCATION_FIELDS, row)), 'report_count': 1}],
+                                version=version)
+    assert heatmaps(client) == before == rebuilt(client)
@@ -0,0 +1,16 @@
+# A point on each edge of the bbox, where its float32 R*Tree box pokes outside it
+EDGE_POINTS = [(10.7, 79.15), (10.9, 79.15), (10.8, 79.1), (10.8, 79.2)]
+
+def add_points(client, points):
+    for lat, lon in points:
+        client.post('/add_location', json={'type': 'schools', 'lat': lat, 'lon': lon, 'speed': 30,
+                                           'timestamp': '2024-01-01T10:00:00+05:30'})
+
+def test_bbox_keeps_points_on_the_edge(client):
+    add_points(client, EDGE_POINTS)
+    features = client.get('/export?bbox=79.1,10.7,79.2,10.9').json['features']
+    assert sorted(tuple(f['geometry']['coordinates'][::-1]) for f in features) == sorted(EDGE_POINTS)
+
+def test_bbox_excludes_points_just_outside(client):
+    add_points(client, [(10.7 - 1e-7, 79.15), (10.8, 79.2 + 1e-7)])
+    assert client.get('/export?bbox=79.1,10.7,79.2,10.9').json['features'] == []
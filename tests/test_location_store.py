@@ -0,0 +1,76 @@
+import threading
+import time
+
+import app as dashboard
+
+SCHOOL = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+# Commit an update outside the request cycle and return the before/after dicts and change version
+def update_speed(location_id, speed):
+    conn = dashboard.connect_db()
+    old = dashboard.fetch_location(conn, location_id)
+    conn.execute('UPDATE locations SET speed=? WHERE id=?', (speed, location_id))
+    version = dashboard.data_version(conn)
+    conn.commit()
+    return old, dict(old, speed=float(speed)), version
+
+def test_late_write_through_does_not_overwrite_newer_rows(client):
+    client.post('/add_location', json=SCHOOL)
+    client.get('/get_locations')
+    first = update_speed(1, 50)
+    second = update_speed(1, 70)
+    # A read syncs the store past both writes before either callback has run
+    assert client.get('/get_locations').json[0]['speed'] == 70
+    # The later write's callback runs first, then the earlier one
+    for old, new, version in (second, first):
+        dashboard.locations_changed(removed=[old], added=[new], version=version)
+    assert client.get('/get_locations').json[0]['speed'] == 70
+    assert client.get('/store_stats?verify=1').json['rebuilt_columns'] == []
+
+def test_late_insert_callback_does_not_resurrect_deleted_row(client):
+    client.get('/get_locations')
+    conn = dashboard.connect_db()
+    row = dashboard.location_row(SCHOOL)
+    location_id, = dashboard.insert_locations(conn, [row])
+    inserted = dashboard.data_version(conn)
+    conn.commit()
+    conn.execute('DELETE FROM locations WHERE id=?', (location_id,))
+    conn.commit()
+    assert client.get('/get_locations').json == []
+    dashboard.locations_changed(added=[{'id': location_id, **dict(zip(dashboard.LOCATION_FIELDS, row)), 'report_count': 1}],
+                                version=inserted)
+    assert client.get('/get_locations').json == []
+    assert client.get('/store_stats?verify=1').json['rebuilt_columns'] == []
+
+def test_write_through_follows_own_writes(client):
+    client.post('/add_location', json=SCHOOL)
+    client.get('/get_locations')
+    version = dashboard.location_store.version
+    client.patch('/locations/1', json={'speed': 45})
+    assert dashboard.location_store.version == version + 1
+    assert client.get('/get_locations').json[0]['speed'] == 45
+
+def test_reads_overlapping_writes_do_not_reload(client, monkeypatch):
+    client.post('/add_location', json=SCHOOL)
+    client.get('/get_locations')
+    loads = []
+    load = dashboard.location_store.load
+    monkeypatch.setattr(dashboard.location_store, 'load', lambda conn: loads.append(1) or load(conn))
+    data_version = dashboard.data_version
+    # Widen the window between reading the version and acting on it
+    def slow_data_version(conn):
+        version = data_version(conn)
+        time.sleep(0.002)
+        return version
+    monkeypatch.setattr(dashboard, 'data_version', slow_data_version)
+    def write():
+        for speed in range(40, 90):
+            old, new, version = update_speed(1, speed)
+            dashboard.locations_changed(removed=[old], added=[new], version=version)
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        client.get('/get_locations')
+    writer.join()
+    assert client.get('/get_locations').json[0]['speed'] == 89
+    assert loads == []
@@ -0,0 +1,28 @@
+import random
+
+import app as dashboard
+
+# Every page of /locations_page for the filters, following next_after_id
+def all_pages(client, query, limit=7):
+    ids, after_id = [], 0
+    while after_id is not None:
+        page = client.get('/locations_page?limit=%d&after_id=%d&%s' % (limit, after_id, query)).json
+        ids += [loc['id'] for loc in page['locations']]
+        after_id = page['next_after_id']
+    return ids
+
+def test_pages_match_export_for_large_and_small_boxes(client):
+    random.seed(3)
+    (south, west), (north, east) = dashboard.TANJORE_BOUNDS
+    points = [(random.uniform(south, north), random.uniform(west, east)) for _ in range(200)]
+    points += [(random.uniform(10.5, 10.6), random.uniform(79.1, 79.18)) for _ in range(40)]
+    random.shuffle(points)
+    for lat, lon in points:
+        client.post('/add_location', json={'type': random.choice(dashboard.LOCATION_TYPES), 'lat': lat, 'lon': lon,
+                                           'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'})
+    # The district, which walks the rowid, and a box small enough for the R*Tree
+    for bbox in ('78.8,10.05,79.7,11.2', '79.1,10.5,79.18,10.6'):
+        for query in ('bbox=' + bbox, 'bbox=%s&type=schools' % bbox):
+            expected = [f['id'] for f in client.get('/export?' + query).json['features']]
+            assert expected
+            assert all_pages(client, query) == sorted(expected)
@@ -0,0 +1,41 @@
+import csv
+import io
+import json
+
+import pytest
+
+import app as dashboard
+
+ACCIDENT = {'type': 'accidents', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+# An incident merged from three reports, next to a lone report
+@pytest.fixture
+def merged(client, monkeypatch):
+    monkeypatch.setitem(dashboard.app.config, 'DEDUP_RADIUS_M', 50)
+    client.get('/get_locations')
+    for lat in (10.8, 10.8001, 10.7999):
+        client.post('/add_location', json=dict(ACCIDENT, lat=lat))
+    client.post('/add_location', json=dict(ACCIDENT, lat=10.9))
+    return client
+
+def counts(locations):
+    return {loc['id']: loc['report_count'] for loc in locations}
+
+@pytest.mark.parametrize('store', [True, False])
+def test_reads_return_report_count(merged, monkeypatch, store):
+    monkeypatch.setitem(dashboard.app.config, 'LOCATION_STORE', store)
+    assert counts(merged.get('/get_locations').json) == {1: 3, 2: 1}
+    columnar = merged.get('/get_locations?format=columnar').json['blocks'][0]
+    assert dict(zip(columnar['id'], columnar['report_count'])) == {1: 3, 2: 1}
+    assert counts(merged.get('/locations_page').json['locations']) == {1: 3, 2: 1}
+    features = merged.get('/export').json['features']
+    assert {f['id']: f['properties']['report_count'] for f in features} == {1: 3, 2: 1}
+    rows = csv.DictReader(io.StringIO(merged.get('/export?format=csv').get_data(as_text=True)))
+    assert {int(r['id']): int(r['report_count']) for r in rows} == {1: 3, 2: 1}
+
+def test_changes_carry_report_count(merged):
+    assert json.loads(dashboard._events[-2]['data'])['report_count'] == 3
+    merged.patch('/locations/1', json={'speed': 45})
+    assert json.loads(dashboard._events[-1]['data'])['report_count'] == 3
+    assert counts(merged.get('/get_locations?since=0').json['changes']) == {1: 3, 2: 1}
+    assert merged.get('/store_stats?verify=1').json['rebuilt_columns'] == []
@@ -0,0 +1,38 @@
+import time
+
+from werkzeug.datastructures import MultiDict
+
+import app as dashboard
+
+OLD = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2020-01-01T10:00:00+05:30'}
+NEW = dict(OLD, timestamp='2099-01-01T10:00:00+05:30')
+
+def tombstones():
+    conn = dashboard.connect_db()
+    return conn.execute('SELECT COUNT(*) FROM location_changes WHERE deleted = 1').fetchone()[0]
+
+def changes(client, since):
+    return client.get('/get_locations?since=%d' % since).json
+
+def test_retention_prunes_tombstones_of_earlier_runs(client):
+    for lat in (10.7, 10.8, 10.9):
+        client.post('/add_location', json=dict(OLD, lat=lat))
+    client.post('/add_location', json=NEW)
+    before = changes(client, 0)['version']
+    # Another worker's store, which only catches up through the change log
+    other = dashboard.LocationStore()
+    other.load(dashboard.connect_db())
+    cutoff = int(time.time())
+    assert dashboard.apply_retention(cutoff) == 3
+    # This run's tombstones stay for readers that polled before it
+    assert tombstones() == 3
+    assert sorted(changes(client, before)['deleted']) == [1, 2, 3]
+    after = changes(client, 0)['version']
+    assert dashboard.apply_retention(cutoff) == 0
+    # Only the newest change is kept, so the version does not go back
+    assert tombstones() == 1
+    assert changes(client, 0)['version'] == after
+    assert changes(client, before)['reset'] is True
+    assert changes(client, after) == {'version': after, 'changes': [], 'deleted': []}
+    other.ensure(dashboard.connect_db())
+    assert [r[0] for r in other.rows(other.select(MultiDict())).fetchall()] == [4]
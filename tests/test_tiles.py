@@ -0,0 +1,26 @@
+import app as dashboard
+
+def test_tile_keeps_points_on_its_west_and_north_edges(client):
+    z = 16
+    x, y = dashboard.lonlat_to_tile(79.13, 10.79, z)
+    west, north = dashboard.tile_to_lonlat(x, y, z)
+    east, south = dashboard.tile_to_lonlat(x + 1, y + 1, z)
+    points = [(north, (west + east) / 2), ((south + north) / 2, west), (north, west)]
+    for lat, lon in points:
+        client.post('/add_location', json={'type': 'schools', 'lat': lat, 'lon': lon, 'speed': 30,
+                                           'timestamp': '2024-01-01T10:00:00+05:30'})
+    features = client.get('/tiles/%d/%d/%d' % (z, x, y)).json['features']
+    assert sorted(tuple(f['geometry']['coordinates'][::-1]) for f in features) == sorted(points)
+    # Neither neighbour claims them, each point is in exactly one tile
+    assert client.get('/tiles/%d/%d/%d' % (z, x - 1, y)).json['features'] == []
+    assert client.get('/tiles/%d/%d/%d' % (z, x, y - 1)).json['features'] == []
+
+def test_delete_without_id_is_rejected(client):
+    client.post('/add_location', json={'type': 'schools', 'lat': 10.79, 'lon': 79.13, 'speed': 30})
+    x, y = dashboard.lonlat_to_tile(79.13, 10.79, 16)
+    assert len(client.get('/tiles/16/%d/%d' % (x, y)).json['features']) == 1
+    for body in ({}, [], {'id': 'first'}, None):
+        r = client.post('/delete_location', json=body)
+        assert r.status_code == 400 and r.json['message'] == 'id is required'
+    assert client.post('/delete_location', json={'id': 1}).status_code == 200
+    assert client.get('/tiles/16/%d/%d' % (x, y)).json['features'] == []
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+import app as dashboard
+
+SCHOOL = {'type': 'schools', 'lat': 10.8, 'lon': 79.1, 'speed': 30, 'timestamp': '2024-01-01T10:00:00+05:30'}
+
+# Client with ASYNC_WRITES on; the writer is stopped afterwards so it does not outlive the database
+@pytest.fixture
+def async_client(client, monkeypatch):
+    monkeypatch.setitem(dashboard.app.config, 'ASYNC_WRITES', True)
+    yield client
+    dashboard.flush_writes()
+    dashboard._writer_thread = dashboard._write_queue = None
+
+def wait_committed(ticket, timeout=5):
+    deadline = time.monotonic() + timeout
+    while dashboard.write_stats['committed_ticket'] < ticket:
+        assert time.monotonic() < deadline, 'write-behind batch not committed'
+        time.sleep(0.01)
+
+def test_writer_survives_failing_cache_update(async_client, monkeypatch):
+    async_client.get('/get_locations')
+    calls = []
+    def invalidate_tiles(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise OSError('disk full')
+    monkeypatch.setattr(dashboard, 'invalidate_tiles', invalidate_tiles)
+    wait_committed(async_client.post('/add_location', json=SCHOOL).json['ticket'])
+    assert dashboard._writer_thread.is_alive()
+    wait_committed(async_client.post('/add_location', json=dict(SCHOOL, lat=10.81)).json['ticket'])
+    assert len(calls) == 2
+    assert len(async_client.get('/get_locations').json) == 2
+
+def test_dead_writer_is_restarted(async_client):
+    wait_committed(async_client.post('/add_location', json=SCHOOL).json['ticket'])
+    dead = threading.Thread(target=lambda: None)
+    dead.start()
+    dead.join()
+    # Stop the live writer and leave a dead thread in its place
+    dashboard.flush_writes()
+    dashboard._writer_thread = dead
+    wait_committed(async_client.post('/add_location', json=dict(SCHOOL, lat=10.81)).json['ticket'])
+    assert dashboard._writer_thread is not dead and dashboard._writer_thread.is_alive()
+    assert len(async_client.get('/get_locations').json) == 2
+
+def test_batch_waits_for_the_write_lock(async_client, monkeypatch):
+    monkeypatch.setitem(dashboard.app.config, 'SQLITE_BUSY_TIMEOUT', 20)
+    retries = dashboard.write_stats['retries']
+    # Another writer holds the lock well past the busy timeout
+    holder = dashboard.connect_db()
+    holder.execute('BEGIN IMMEDIATE')
+    ticket = async_client.post('/add_location', json=SCHOOL).json['ticket']
+    time.sleep(0.5)
+    holder.commit()
+    wait_committed(ticket)
+    assert dashboard.write_stats['retries'] > retries
+    assert ticket not in async_client.get('/write_queue_stats').json['lost_tickets']
+    assert len(async_client.get('/get_locations').json) == 1
+
+def test_lost_tickets_are_reported(async_client, monkeypatch):
+    write_locations = dashboard.write_locations
+    def failing(conn, rows, *args):
+        if rows[0][2] == 79.0:
+            raise dashboard.sqlite3.DatabaseError('disk I/O error')
+        return write_locations(conn, rows, *args)
+    monkeypatch.setattr(dashboard, 'write_locations', failing)
+    lost = async_client.post('/add_location', json=dict(SCHOOL, lon=79.0)).json['ticket']
+    deadline = time.monotonic() + 5
+    while lost not in async_client.get('/write_queue_stats').json['lost_tickets']:
+        assert time.monotonic() < deadline, 'lost ticket not reported'
+        time.sleep(0.01)
+    # The writer carries on with the next batch
+    wait_committed(async_client.post('/add_location', json=SCHOOL).json['ticket'])
+    assert len(async_client.get('/get_locations').json) == 1
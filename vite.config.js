@@ -3,6 +3,8 @@ import vue from '@vitejs/plugin-vue';
 
 export default defineConfig({
   plugins: [vue()],
+  // Built asset URLs are served by the /assets route in app.py
+  base: '/assets/',
   server: {
     port: 3000,
     proxy: {
@@ -11,6 +13,12 @@ export default defineConfig({
     }
   },
   build: {
-    outDir: '../dist'
+    outDir: 'static/dist',
+    assetsDir: '',
+    emptyOutDir: true,
+    manifest: true,
+    rollupOptions: {
+      input: 'assets/main.js'
+    }
   }
-});
\ No newline at end of file
+});